@@ -2,6 +2,8 @@ import streamlit as st
 import pandas as pd
 import datetime
 
+import compare_engine
+
 # Настройка страницы
 st.set_page_config(page_title="Сравнение Excel (Сортировка и Даты)", layout="wide")
 
@@ -12,190 +14,222 @@ st.markdown("""
 2.  **Даты:** Опция игнорировать время при сравнении дат.
 """)
 
+
+# --- ФРАГМЕНТЫ ---
+# Каждый фрагмент перезапускается независимо: изменение настроек вкладки
+# не перечитывает файлы и не трогает блок результатов.
+
+def _refresh_results():
+    # Результат уже показан - пересобираем его из кэша без повторного сравнения
+    # (при смене ключа сортировки результат скрывается до нового запуска)
+    st.session_state['refresh_results'] = 'compared_run' in st.session_state
+
+
+@st.fragment
+def sheet_settings(src1, sheet):
+    with st.expander(f"Настройки для вкладки: '{sheet}'"):
+        # Заголовки берутся из кэша (читается только первая строка листа)
+        columns = compare_engine.sheet_columns(src1, sheet)
+
+        # ВЫБОР КЛЮЧЕВОЙ КОЛОНКИ ДЛЯ СОРТИРОВКИ
+        st.selectbox(
+            f"🔑 Колонка для сортировки (Ключ):",
+            columns,
+            key=f"sort_{sheet}",
+            help="Обычно это 'ID', 'Номер', 'Артикул'. Файлы будут отсортированы по этой колонке перед сравнением.",
+            on_change=_refresh_results
+        )
+
+        # ВЫБОР ИГНОРИРУЕМЫХ КОЛОНОК
+        st.multiselect(
+            f"❌ Игнорировать столбцы:",
+            columns,
+            key=f"ignore_{sheet}",
+            on_change=_refresh_results
+        )
+    if st.session_state.pop('refresh_results', False):
+        st.rerun()
+
+
+def show_quick_look(q, by_key):
+    st.write(
+        f"Просмотрено строк: {q.rows_sampled} ({q.blocks_sampled} из {q.blocks_total} блоков). "
+        f"Строк в файлах: {q.rows_old} → {q.rows_new}."
+    )
+    # Колонки сопоставлены по строкам выборки (как в полном сравнении)
+    for message in q.schema.messages():
+        st.warning(message)
+    if q.key_col is not None:
+        st.write(
+            f"🔑 По ключу '{q.key_col}' (точно): новых **{q.added_by_key}**, удаленных **{q.deleted_by_key}**."
+        )
+    if by_key:
+        changed, top_columns = q.changed_by_key, q.top_columns_by_key
+    else:
+        changed, top_columns = q.changed, q.top_columns
+        st.write(f"🟢 Добавлено (строк больше во втором файле): **{q.added_positional}**")
+    st.write(
+        f"🟡 Изменено: **≈ {changed.count}** ({changed.rate:.2%}), "
+        f"95% интервал: {changed.count_low} – {changed.count_high}"
+    )
+    if q.duplicate_keys_old or q.duplicate_keys_new:
+        st.warning(f"Дубли ключа: в старом файле {q.duplicate_keys_old}, в новом {q.duplicate_keys_new}.")
+    if top_columns:
+        st.dataframe(
+            pd.DataFrame(top_columns, columns=['Колонка', 'Изменений в выборке', 'Доля строк']),
+            use_container_width=True
+        )
+
+
+@st.fragment
+def quick_look_view(src1, src2, selected_sheets):
+    with st.expander("⚡ Быстрая оценка по выборке (до полного сравнения)"):
+        st.caption(
+            "Читается случайная выборка блоков строк обоих файлов, без полного разбора. "
+            "Строки сопоставляются по колонке сортировки. Помогает понять масштаб изменений "
+            "и подобрать ключ и игнорируемые колонки."
+        )
+        sheet = st.selectbox("Вкладка для оценки:", selected_sheets, key="ql_sheet")
+        col1, col2 = st.columns(2)
+        block_size = col1.number_input("Строк в блоке:", min_value=50, max_value=10000, value=500, step=50, key="ql_block")
+        sample_blocks = col2.number_input("Блоков в выборке:", min_value=1, max_value=1000, value=20, key="ql_blocks")
+
+        if st.button("⚡ Оценить", key="ql_run"):
+            try:
+                with st.spinner("Оцениваем по выборке..."):
+                    q = compare_engine.quick_look(
+                        src1, src2, sheet, sheet,
+                        key_col=st.session_state.get(f"sort_{sheet}"),
+                        ignored=tuple(st.session_state.get(f"ignore_{sheet}", [])),
+                        block_size=int(block_size),
+                        sample_blocks=int(sample_blocks)
+                    )
+                show_quick_look(q, by_key=q.key_col is not None)
+            except Exception as e:
+                st.error(f"Не удалось выполнить быструю оценку: {e}")
+
+
+@st.fragment
+def results_view(src1, src2, selected_sheets):
+    # Глобальная настройка дат
+    ignore_time_in_dates = st.checkbox("Игнорировать время в полях с датой", value=True)
+
+    # Параметры, от которых зависит само сравнение (игнорируемые колонки сюда не входят)
+    sort_cols = tuple(st.session_state.get(f"sort_{sheet}") for sheet in selected_sheets)
+    run = (src1.digest, src2.digest, tuple(selected_sheets), sort_cols, ignore_time_in_dates)
+
+    if st.button("🚀 Запустить сравнение"):
+        if not selected_sheets:
+            st.warning("Выберите вкладки.")
+            return
+        st.session_state['compared_run'] = run
+    if st.session_state.get('compared_run') != run:
+        return
+
+    try:
+        all_results = {}
+        keyed_results = {}
+        progress_bar = st.progress(0)
+        progress_text = st.empty()
+
+        # Быстрый путь: листы с одинаковыми сырыми XML-частями не читаем и не сравниваем
+        skipped_sheets = compare_engine.identical_sheets(src1, src2, selected_sheets)
+
+        # --- 4. ЛОГИКА СРАВНЕНИЯ ---
+        for i, sheet in enumerate(selected_sheets):
+            if sheet in skipped_sheets:
+                progress_text.text(f"Вкладка '{sheet}': данные совпадают побайтно, сравнение пропущено.")
+                all_results[sheet] = pd.DataFrame()
+                progress_bar.progress((i + 1) / len(selected_sheets))
+                continue
+
+            progress_text.text(f"Сравниваем вкладку '{sheet}'...")
+            # Общий движок: сортировка по ключу, учет дат и сравнение по ключу за один проход
+            sort_col = st.session_state.get(f"sort_{sheet}")
+            comparison = compare_engine.compare_sheets(
+                src1, src2, sheet, sheet,
+                key_col=sort_col,
+                sort_col=sort_col,
+                ignore_time_in_dates=ignore_time_in_dates
+            )
+            # Предупреждения сортировки и расхождения структуры листа (колонки выровнены движком)
+            for warning in comparison.warnings + comparison.schema.messages():
+                st.warning(f"Вкладка '{sheet}': {warning}")
+            # Игнорируемые колонки применяются к готовой карте различий
+            ignored = st.session_state.get(f"ignore_{sheet}", [])
+            all_results[sheet] = comparison.positional(ignored)
+            keyed_results[sheet] = (comparison, ignored)
+
+            progress_bar.progress((i + 1) / len(selected_sheets))
+
+        # --- 5. ВЫВОД ---
+        st.subheader("Результат")
+        for sheet, df_res in all_results.items():
+            count = len(df_res)
+            if sheet in skipped_sheets:
+                st.success(f"⚡ Вкладка '{sheet}': Идентична (сырые данные листа совпадают, чтение и сравнение пропущены).")
+            elif count == 0:
+                st.success(f"✅ Вкладка '{sheet}': Идентична (с учетом исключений и сортировки).")
+            else:
+                st.info(f"📄 Вкладка: {sheet} (Найдено изменений: {count})")
+                by_key, ignored = keyed_results[sheet]
+                if by_key.key_col is not None:
+                    st.caption(
+                        f"По ключу '{by_key.key_col}': новых {len(by_key.added)}, "
+                        f"измененных {len(by_key.changed(ignored))}, удаленных {len(by_key.deleted)}."
+                    )
+                st.dataframe(df_res, use_container_width=True)
+
+                csv = df_res.to_csv(index=False).encode('utf-8-sig')
+                st.download_button(
+                    label=f"📥 Скачать {sheet}",
+                    data=csv,
+                    file_name=f'result_{sheet}.csv',
+                    mime='text/csv',
+                    key=f'dl_{sheet}'
+                )
+
+    except Exception as e:
+        st.error(f"Ошибка: {e}")
+
+
 # --- 1. ПРИНИМАЕМ ДВА ФАЙЛА ---
 st.sidebar.header("Загрузка файлов")
 file1 = st.sidebar.file_uploader("1. Файл за День 1 (Старый)", type=['xlsx'])
 file2 = st.sidebar.file_uploader("2. Файл за День 2 (Новый)", type=['xlsx'])
 
+# Состояние общего (для всех сессий) кэша разобранных листов
+with st.sidebar.expander("📈 Общий кэш листов"):
+    st.json(compare_engine.cache_metrics())
+
 if file1 and file2:
     try:
-        xls1 = pd.ExcelFile(file1)
-        xls2 = pd.ExcelFile(file2)
-        
-        sheets1 = xls1.sheet_names
-        sheets2 = xls2.sheet_names
-        
+        # Содержимое хэшируется один раз на загрузку, список листов берется из кэша;
+        # листы прежних загрузок этой сессии освобождаются в общем кэше
+        src1, src2 = compare_engine.source_files(file1, file2)
+
+        sheets1 = compare_engine.sheet_names(src1)
+        sheets2 = compare_engine.sheet_names(src2)
+
         common_sheets = list(set(sheets1) & set(sheets2))
         common_sheets.sort()
-        
+
         if not common_sheets:
             st.error("Нет общих вкладок для сравнения!")
         else:
             # --- 2. ВЫБОР ВКЛАДОК ---
             selected_sheets = st.multiselect("Выберите вкладки:", common_sheets, default=common_sheets)
-            
-            ignored_cols_map = {}
-            sort_col_map = {} # Карта для колонок сортировки
-            
+
             if selected_sheets:
                 st.subheader("Настройки сравнения")
-                
+
                 # Для каждой вкладки задаем настройки
                 for sheet in selected_sheets:
-                    with st.expander(f"Настройки для вкладки: '{sheet}'"):
-                        df_preview = pd.read_excel(xls1, sheet_name=sheet, nrows=1)
-                        columns = df_preview.columns.tolist()
-                        
-                        # ВЫБОР КЛЮЧЕВОЙ КОЛОНКИ ДЛЯ СОРТИРОВКИ
-                        sort_key = st.selectbox(
-                            f"🔑 Колонка для сортировки (Ключ):", 
-                            columns, 
-                            key=f"sort_{sheet}",
-                            help="Обычно это 'ID', 'Номер', 'Артикул'. Файлы будут отсортированы по этой колонке перед сравнением."
-                        )
-                        sort_col_map[sheet] = sort_key
-                        
-                        # ВЫБОР ИГНОРИРУЕМЫХ КОЛОНОК
-                        ignored = st.multiselect(
-                            f"❌ Игнорировать столбцы:", 
-                            columns, 
-                            key=f"ignore_{sheet}"
-                        )
-                        ignored_cols_map[sheet] = ignored
-            
-            if st.button("🚀 Запустить сравнение"):
-                if not selected_sheets:
-                    st.warning("Выберите вкладки.")
-                else:
-                    all_results = {}
-                    progress_bar = st.progress(0)
-                    
-                    # Глобальная настройка дат
-                    ignore_time_in_dates = st.checkbox("Игнорировать время в полях с датой", value=True)
-                    
-                    # --- 4. ЛОГИКА СРАВНЕНИЯ ---
-                    for i, sheet in enumerate(selected_sheets):
-                        df1 = pd.read_excel(xls1, sheet_name=sheet).fillna('')
-                        df2 = pd.read_excel(xls2, sheet_name=sheet).fillna('')
-                        
-                        # --- ВАЖНО: СОРТИРОВКА ---
-                        # Сортируем оба датафрейма по выбранной колонке, чтобы выровнять строки
-                        sort_col = sort_col_map[sheet]
-                        try:
-                            df1 = df1.sort_values(by=sort_col).reset_index(drop=True)
-                            df2 = df2.sort_values(by=sort_col).reset_index(drop=True)
-                        except Exception as e:
-                            st.warning(f"Не удалось отсортировать вкладку '{sheet}' по колонке '{sort_col}'. Сравнение может быть неточным. Ошибка: {e}")
-
-                        # Получаем список колонок для игнорирования
-                        current_ignored = ignored_cols_map.get(sheet, [])
-                        cols_to_compare = [c for c in df1.columns if c not in current_ignored]
-                        
-                        # Определяем, какие колонки похожи на даты, чтобы обрабатывать их отдельно
-                        date_columns = []
-                        if ignore_time_in_dates:
-                            for col in df1.columns:
-                                if pd.api.types.is_datetime64_any_dtype(df1[col]):
-                                    date_columns.append(col)
-                        
-                        max_rows = max(len(df1), len(df2))
-                        results = []
-                        
-                        for row_idx in range(max_rows):
-                            row_data = {}
-                            status = ""
-                            
-                            # Логика НОВОЙ строки (если во втором файле строк больше)
-                            if row_idx >= len(df1):
-                                status = "🟢 Добавлено"
-                                for col in df2.columns:
-                                    row_data[f"{col}_Day2"] = df2.at[row_idx, col]
-                                for col in df1.columns:
-                                    row_data[f"{col}_Day1"] = ""
-                            
-                            # Логика УДАЛЕННОЙ строки (пропускаем)
-                            elif row_idx >= len(df2):
-                                continue 
-                            
-                            # Логика ИЗМЕНЕНИЯ
-                            else:
-                                is_different = False
-                                
-                                for col in df1.columns:
-                                    val1 = df1.at[row_idx, col]
-                                    val2 = df2.at[row_idx, col] if col in df2.columns else ""
-                                    
-                                    row_data[f"{col}_Day1"] = val1
-                                    row_data[f"{col}_Day2"] = val2
-                                    
-                                    # Логика сравнения с учетом дат
-                                    if col in cols_to_compare:
-                                        diff = False
-                                        
-                                        if ignore_time_in_dates and (col in date_columns or pd.api.types.is_datetime64_any_dtype(df2[col])):
-                                            # Пытаемся преобразовать к дате и сравнить только дату
-                                            try:
-                                                d1 = pd.to_datetime(val1, errors='coerce')
-                                                d2 = pd.to_datetime(val2, errors='coerce')
-                                                
-                                                if pd.notna(d1) and pd.notna(d2):
-                                                    # Сравниваем .date() (без времени)
-                                                    if d1.date() != d2.date():
-                                                        diff = True
-                                                else:
-                                                    # Если одна из них не дата, сравниваем как строки
-                                                    if str(val1) != str(val2):
-                                                        diff = True
-                                            except:
-                                                # Ошибка парсинга даты - сравниваем как строки
-                                                if str(val1) != str(val2):
-                                                    diff = True
-                                        else:
-                                            # Обычное сравнение строк/чисел
-                                            if str(val1) != str(val2):
-                                                diff = True
-                                        
-                                        if diff:
-                                            is_different = True
-                                
-                                if is_different:
-                                    status = "🟡 Изменено"
-                                else:
-                                    status = "⚪ Без изменений"
-                            
-                            # Фильтр
-                            if status in ["🟢 Добавлено", "🟡 Изменено"]:
-                                row_data['Status'] = status
-                                results.append(row_data)
-
-                        if results:
-                            df_result = pd.DataFrame(results)
-                            cols = ['Status'] + [c for c in df_result.columns if c != 'Status']
-                            df_result = df_result[cols]
-                            all_results[sheet] = df_result
-                        else:
-                            all_results[sheet] = pd.DataFrame()
-                            
-                        progress_bar.progress((i + 1) / len(selected_sheets))
-                    
-                    # --- 5. ВЫВОД ---
-                    st.subheader("Результат")
-                    for sheet, df_res in all_results.items():
-                        count = len(df_res)
-                        if count == 0:
-                            st.success(f"✅ Вкладка '{sheet}': Идентична (с учетом исключений и сортировки).")
-                        else:
-                            st.info(f"📄 Вкладка: {sheet} (Найдено изменений: {count})")
-                            st.dataframe(df_res, use_container_width=True)
-                            
-                            csv = df_res.to_csv(index=False).encode('utf-8-sig')
-                            st.download_button(
-                                label=f"📥 Скачать {sheet}",
-                                data=csv,
-                                file_name=f'result_{sheet}.csv',
-                                mime='text/csv',
-                                key=f'dl_{sheet}'
-                            )
+                    sheet_settings(src1, sheet)
+
+                quick_look_view(src1, src2, selected_sheets)
+
+            results_view(src1, src2, selected_sheets)
 
     except Exception as e:
         st.error(f"Ошибка: {e}")
@@ -1,5 +1,6 @@
 import streamlit as st
-import pandas as pd
+
+import compare_engine
 
 st.set_page_config(page_title="Поиск новых строк (С выбором листов)", layout="wide")
 
@@ -13,14 +14,18 @@ st.sidebar.header("Шаг 1: Загрузка файлов")
 file_old = st.sidebar.file_uploader("1. Старый файл (Old)", type=['xlsx'])
 file_new = st.sidebar.file_uploader("2. Новый файл (New)", type=['xlsx'])
 
+# Состояние общего (для всех сессий) кэша разобранных листов
+with st.sidebar.expander("📈 Общий кэш листов"):
+    st.json(compare_engine.cache_metrics())
+
 if file_old and file_new:
     try:
-        # Получаем список всех вкладок в обоих файлах
-        xls_old = pd.ExcelFile(file_old)
-        xls_new = pd.ExcelFile(file_new)
+        # Получаем список всех вкладок в обоих файлах (из кэша, файл хэшируется один раз на загрузку;
+        # листы прежних загрузок этой сессии освобождаются в общем кэше)
+        src_old, src_new = compare_engine.source_files(file_old, file_new)
         
-        sheets_old = xls_old.sheet_names
-        sheets_new = xls_new.sheet_names
+        sheets_old = compare_engine.sheet_names(src_old)
+        sheets_new = compare_engine.sheet_names(src_new)
         
         # --- 2. ВЫБОР ВКЛАДОК (ЛИСТОВ) ---
         st.header("Шаг 2: Выберите листы таблиц для сравнения")
@@ -43,11 +48,8 @@ if file_old and file_new:
         # Проверяем, что выбраны листы, и загружаем их для анализа колонок
         if sheet_old and sheet_new:
             # Читаем заголовки из выбранных листов (только первую строку)
-            df_sample_old = pd.read_excel(xls_old, sheet_name=sheet_old, nrows=1)
-            df_sample_new = pd.read_excel(xls_new, sheet_name=sheet_new, nrows=1)
-            
-            cols_old = df_sample_old.columns.tolist()
-            cols_new = df_sample_new.columns.tolist()
+            cols_old = compare_engine.sheet_columns(src_old, sheet_old)
+            cols_new = compare_engine.sheet_columns(src_new, sheet_new)
             
             # Находим общие колонки (они пригодятся для выбора ID)
             common_cols = list(set(cols_old) & set(cols_new))
@@ -73,36 +75,20 @@ if file_old and file_new:
             if st.button("🔍 Найти новые строки"):
                 st.info("Обрабатываем данные...")
                 
-                # Читаем данные полностью
-                df_old = pd.read_excel(xls_old, sheet_name=sheet_old)
-                df_new = pd.read_excel(xls_new, sheet_name=sheet_new)
-                
-                st.write(f"Загружено строк в старом файле: {len(df_old)}")
-                st.write(f"Загружено строк в новом файле: {len(df_new)}")
-                
-                # Очистка ключевой колонки (приводим к строке и убираем NaN)
-                df_old[key_col] = df_old[key_col].astype(str).replace('nan', '')
-                df_new[key_col] = df_new[key_col].astype(str).replace('nan', '')
-                
-                # --- ЛОГИКА ПОИСКА ---
-                # Делаем слияние: ищем строки из df_new, которых нет в df_old
-                merged = pd.merge(
-                    df_new, 
-                    df_old[[key_col]], 
-                    on=key_col, 
-                    how='left', 
-                    indicator=True
+                # Общий движок: разбор и сравнение по ключу кэшируются по содержимому файлов
+                comparison = compare_engine.compare_sheets(
+                    src_old, src_new, sheet_old, sheet_new,
+                    key_col=key_col
                 )
                 
-                # Отфильтровываем только новые (left_only)
-                new_rows_df = merged[merged['_merge'] == 'left_only']
-                
-                # Удаляем служебную колонку
-                new_rows_df = new_rows_df.drop(columns=['_merge'])
+                st.write(f"Загружено строк в старом файле: {comparison.rows_old}")
+                st.write(f"Загружено строк в новом файле: {comparison.rows_new}")
+                # Расхождения структуры: новые/удаленные/переименованные колонки, смена типов, дубли ключа
+                for message in comparison.schema.messages():
+                    st.warning(message)
                 
-                # Удаляем ненужные колонки, если выбраны
-                if cols_to_drop:
-                    new_rows_df = new_rows_df.drop(columns=[c for c in cols_to_drop if c in new_rows_df.columns])
+                # Новые строки (ID из нового файла, которых нет в старом) без ненужных колонок
+                new_rows_df = comparison.new_rows(drop_cols=cols_to_drop)
                 
                 # --- 5. РЕЗУЛЬТАТ ---
                 st.header("Результат")
@@ -0,0 +1,134 @@
+import streamlit as st
+
+import compare_engine
+
+st.set_page_config(page_title="Сравнение нового файла с несколькими старыми", layout="wide")
+
+st.title("🗂️ Один новый файл против нескольких старых")
+st.markdown("""
+Сравнивает сегодняшнюю выгрузку сразу с несколькими эталонными файлами (предыдущий день, конец недели, конец месяца...).
+Новый файл разбирается один раз, старые файлы сравниваются параллельно. В общем результате для каждой строки указано,
+относительно какой базы она новая, измененная или удаленная.
+""")
+
+
+# --- ФРАГМЕНТЫ ---
+# Смена игнорируемых колонок не перечитывает файлы и не запускает сравнение
+# заново: готовые карты различий сворачиваются по оставшимся колонкам.
+
+def _refresh_results():
+    st.session_state['refresh_results'] = 'compared_run' in st.session_state
+
+
+@st.fragment
+def ignore_settings(cols_new):
+    st.header("Шаг 4: Игнорируемые колонки (опционально)")
+    st.multiselect(
+        "❌ Не учитывать изменения в колонках:",
+        cols_new,
+        key="ignore_cols",
+        help="Например, дата выгрузки. Строки, где отличаются только эти колонки, не считаются измененными.",
+        on_change=_refresh_results
+    )
+    if st.session_state.pop('refresh_results', False):
+        st.rerun()
+
+
+@st.fragment
+def results_view(src_new, sheet_new, key_col, baselines):
+    # Параметры, от которых зависит само сравнение (игнорируемые колонки сюда не входят)
+    run = (src_new.digest, sheet_new, key_col,
+           tuple((label, src.digest, sheet) for label, src, sheet in baselines))
+
+    # --- 5. ЗАПУСК ---
+    if st.button("🔍 Сравнить со всеми базами"):
+        st.session_state['compared_run'] = run
+    if st.session_state.get('compared_run') != run:
+        return
+
+    ignored = st.session_state.get("ignore_cols", [])
+
+    try:
+        with st.spinner(f"Сравниваем с {len(baselines)} базами..."):
+            batch = compare_engine.compare_batch(src_new, sheet_new, key_col, baselines)
+
+        # --- 6. РЕЗУЛЬТАТ ---
+        st.header("Результат")
+        st.write(f"Строк в новом файле: {batch.rows_new}")
+        st.dataframe(batch.summary(ignored), use_container_width=True)
+
+        for result in batch.baselines:
+            if result.error:
+                st.error(f"База '{result.label}': {result.error}")
+                continue
+            for message in result.schema.messages():
+                st.warning(f"База '{result.label}': {message}")
+
+        combined = batch.combined(ignored)
+        if combined.empty:
+            st.success("✅ Новый файл совпадает со всеми базами (с учетом исключений).")
+            return
+
+        st.dataframe(combined, use_container_width=True)
+
+        csv = combined.to_csv(index=False).encode('utf-8-sig')
+        st.download_button(
+            label="📥 Скачать общий результат (CSV)",
+            data=csv,
+            file_name='batch_result.csv',
+            mime='text/csv'
+        )
+
+    except Exception as e:
+        st.error(f"Ошибка: {e}")
+
+
+# --- 1. ЗАГРУЗКА ---
+st.sidebar.header("Шаг 1: Загрузка файлов")
+file_new = st.sidebar.file_uploader("1. Новый файл (сегодня)", type=['xlsx'])
+files_old = st.sidebar.file_uploader("2. Старые файлы (базы сравнения)", type=['xlsx'], accept_multiple_files=True)
+
+# Состояние общего (для всех сессий) кэша разобранных листов
+with st.sidebar.expander("📈 Общий кэш листов"):
+    st.json(compare_engine.cache_metrics())
+
+if file_new and files_old:
+    try:
+        # Содержимое хэшируется один раз на загрузку, список листов берется из кэша;
+        # листы прежних загрузок этой сессии освобождаются в общем кэше
+        src_new, *srcs_old = compare_engine.source_files(file_new, *files_old)
+
+        # --- 2. ВЫБОР ЛИСТОВ ---
+        st.header("Шаг 2: Выберите листы")
+        sheets_new = compare_engine.sheet_names(src_new)
+        sheet_new = st.selectbox("📂 Лист в Новом файле:", sheets_new)
+
+        baselines = []
+        for i, src_old in enumerate(srcs_old):
+            sheets_old = compare_engine.sheet_names(src_old)
+            # По умолчанию - лист с тем же именем, что и в новом файле
+            default = sheets_old.index(sheet_new) if sheet_new in sheets_old else 0
+            sheet_old = st.selectbox(f"📂 Лист в базе '{src_old.name}':", sheets_old, index=default, key=f"sheet_old_{i}")
+            # Одинаковые имена файлов различаем порядковым номером
+            label = src_old.name if [s.name for s in srcs_old].count(src_old.name) == 1 else f"{src_old.name} #{i + 1}"
+            baselines.append((label, src_old, sheet_old))
+
+        if sheet_new:
+            cols_new = compare_engine.sheet_columns(src_new, sheet_new)
+
+            # --- 3. НАСТРОЙКИ КЛЮЧА ---
+            st.header("Шаг 3: Настройка идентификатора")
+            key_col = st.selectbox(
+                "🔑 Выберите колонку-идентификатор (ID):",
+                cols_new,
+                help="Колонка нового файла; в старых файлах она ищется по имени (или как переименованная)."
+            )
+
+            ignore_settings(cols_new)
+            results_view(src_new, sheet_new, key_col, tuple(baselines))
+
+    except Exception as e:
+        st.error(f"Ошибка: {e}")
+        st.error(str(e))
+else:
+    st.info("Пожалуйста, загрузите новый файл и хотя бы один старый.")
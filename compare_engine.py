@@ -0,0 +1,1627 @@
+import bisect
+import collections
+import difflib
+import hashlib
+import html
+import io
+import math
+import multiprocessing
+import os
+import posixpath
+import random
+import re
+import uuid
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import sheet_cache
+
+# Общий код для приложений сравнения Excel.
+
+# --- ЗАГРУЖЕННЫЕ ФАЙЛЫ ---
+# Кэш Streamlit хэширует аргументы при каждом вызове, а для файла в 100 МБ это
+# заметно дольше, чем перерисовка виджета. Поэтому содержимое файла хэшируется
+# один раз на загрузку, а кэшированные функции получают SourceFile и хэшируют
+# только его digest.
+
+
+@dataclass(frozen=True)
+class SourceFile:
+    name: str
+    digest: str
+    data: bytes = field(repr=False)
+
+
+def source_file(uploaded_file):
+    """SourceFile для st.file_uploader; содержимое хэшируется один раз на загрузку."""
+    digests = st.session_state.setdefault('_source_digests', {})
+    data = uploaded_file.getvalue()
+    if uploaded_file.file_id not in digests:
+        digests[uploaded_file.file_id] = _blake(data).hexdigest()
+    return SourceFile(uploaded_file.name, digests[uploaded_file.file_id], data)
+
+
+def source_files(*uploaded_files):
+    """SourceFile для нескольких загрузок; листы прежних загрузок сессии освобождаются в общем кэше."""
+    sources = [source_file(f) for f in uploaded_files]
+    _sheet_cache().retain(_session_id(), {src.digest for src in sources})
+    return sources
+
+
+_CACHE_ARGS = dict(show_spinner=False, hash_funcs={SourceFile: lambda src: src.digest})
+
+
+@st.cache_data(**_CACHE_ARGS)
+def sheet_names(src):
+    return pd.ExcelFile(io.BytesIO(src.data)).sheet_names
+
+
+@st.cache_data(**_CACHE_ARGS)
+def sheet_columns(src, sheet_name):
+    """Заголовки листа (читается только первая строка)."""
+    return read_columns(src.data, sheet_name)
+
+# --- БЫСТРАЯ ПРОВЕРКА ИДЕНТИЧНЫХ ЛИСТОВ (БЕЗ ЧТЕНИЯ ЯЧЕЕК) ---
+# xlsx - это zip-архив: каждый лист лежит отдельной XML-частью, строки вынесены
+# в общую таблицу sharedStrings, форматы (в т.ч. форматы дат) - в styles.xml.
+# Если XML листа, используемые им строки и стили совпадают, то и данные листа
+# совпадают, поэтому read_excel и сравнение можно пропустить.
+
+NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+# Ячейка со ссылкой на общую строку: <c ... t="s"><v>12</v></c>
+_SHARED_REF_RE = re.compile(rb'(<(?:\w+:)?c\b[^>]*?\st=["\']s["\'][^>]*>\s*<(?:\w+:)?v>)(\d+)(</(?:\w+:)?v>)')
+_SHARED_ATTR_RE = re.compile(rb'\st=["\']s["\']')
+_SI_RE = re.compile(rb'<(?:\w+:)?si\b[^>]*/>|<(?:\w+:)?si\b.*?</(?:\w+:)?si>', re.S)
+_WORKBOOK_PR_RE = re.compile(rb'<(?:\w+:)?workbookPr\b[^>]*>')
+
+
+def _resolve_target(base_part, target):
+    # Пути в .rels бывают абсолютными (/xl/...) и относительными (worksheets/...)
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_part), target))
+
+
+def _read_rels(zf, part):
+    rels_path = posixpath.join(posixpath.dirname(part), '_rels', posixpath.basename(part) + '.rels')
+    rels = {}
+    if rels_path not in zf.namelist():
+        return rels
+    root = ET.fromstring(zf.read(rels_path))
+    for rel in root.iter(f'{{{NS_PKG_REL}}}Relationship'):
+        if rel.get('TargetMode') == 'External':
+            continue
+        rels[rel.get('Id')] = (rel.get('Type', ''), _resolve_target(part, rel.get('Target', '')))
+    return rels
+
+
+def _blake(data=b''):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(data)
+    return h
+
+
+def _workbook_parts(zf):
+    """XML книги, [(имя_листа, путь_к_части)], пути к sharedStrings и styles."""
+    root_rels = _read_rels(zf, '')
+    wb_part = next(
+        (target for rel_type, target in root_rels.values() if rel_type.endswith('/officeDocument')),
+        'xl/workbook.xml',
+    )
+    wb_xml = zf.read(wb_part)
+    wb_rels = _read_rels(zf, wb_part)
+
+    shared_part = styles_part = None
+    for rel_type, target in wb_rels.values():
+        if rel_type.endswith('/sharedStrings'):
+            shared_part = target
+        elif rel_type.endswith('/styles'):
+            styles_part = target
+
+    sheets = []
+    for sheet in ET.fromstring(wb_xml).iter(f'{{{NS_MAIN}}}sheet'):
+        rid = sheet.get(f'{{{NS_REL}}}id')
+        if rid in wb_rels:
+            sheets.append((sheet.get('name'), wb_rels[rid][1]))
+    return wb_xml, sheets, shared_part, styles_part
+
+
+def _hash_part(h, zf, part):
+    with zf.open(part) as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+
+
+def _shared_hashes(zf, part):
+    """Хэши содержимого общих строк (uint64 по индексу) и хэш всей таблицы; таблица читается потоком."""
+    items = bytearray()
+    whole = _blake()
+    if part:
+        buf = b''
+        with zf.open(part) as f:
+            while True:
+                chunk = f.read(_CHUNK_SIZE)
+                whole.update(chunk)
+                buf += chunk
+                cut = _last_si_end(buf) if chunk else len(buf)
+                for item in _SI_RE.findall(buf, 0, cut):
+                    items += hashlib.blake2b(item, digest_size=8).digest()
+                buf = buf[cut:]
+                if not chunk:
+                    break
+    return np.frombuffer(bytes(items), dtype='<u8'), whole.digest()
+
+
+def _hash_sheet(h, zf, part, shared, shared_whole):
+    """Добавляет в h XML листа, где индекс каждой общей строки заменен хэшем ее содержимого.
+
+    Так хэш не зависит от нумерации таблицы строк: новая строка на другом листе
+    сдвигает индексы, но не меняет хэш неизменного листа.
+    """
+    standard = True
+    buf = b''
+    with zf.open(part) as f:
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            buf += chunk
+            # Режем по началу строки <row>, чтобы ячейка не попала в два куска
+            cut = _last_row_start(buf) if chunk else len(buf)
+            if cut:
+                piece = buf[:cut]
+                # split чередует: текст, начало ячейки, индекс, </v>, текст, ...
+                parts = _SHARED_REF_RE.split(piece)
+                indices = np.array(parts[2::4], dtype=np.int64)
+                if len(indices) != len(_SHARED_ATTR_RE.findall(piece)) or (
+                    len(indices) and indices.max() >= len(shared)
+                ):
+                    standard = False
+                if standard:
+                    del parts[2::4]
+                    stripped = b''.join(parts)
+                    h.update(str(len(stripped)).encode())
+                    h.update(stripped)
+                    h.update(shared[indices].tobytes())
+                else:
+                    h.update(piece)
+                buf = buf[cut:]
+            if not chunk:
+                break
+    if not standard:
+        # Нестандартная разметка - берем всю таблицу строк целиком
+        h.update(shared_whole)
+
+
+def sheet_digests(file_bytes):
+    """Хэши листов книги {имя_листа: hex} по сырым XML-частям xlsx.
+
+    Ячейки не разбираются, XML читается потоком. Если архив не удалось
+    прочитать, возвращается пустой словарь - тогда быстрый путь просто не
+    используется.
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+            wb_xml, sheets, shared_part, styles_part = _workbook_parts(zf)
+
+            # Общая часть книги: стили и флаг date1904 влияют на прочитанные значения
+            common = _blake()
+            if styles_part:
+                _hash_part(common, zf, styles_part)
+            pr = _WORKBOOK_PR_RE.search(wb_xml)
+            common.update(pr.group(0) if pr else b'')
+
+            shared, shared_whole = _shared_hashes(zf, shared_part)
+
+            digests = {}
+            for name, part in sheets:
+                h = _blake(common.digest())
+                _hash_sheet(h, zf, part, shared, shared_whole)
+                digests[name] = h.hexdigest()
+            return digests
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, OSError):
+        return {}
+
+
+@st.cache_data(**_CACHE_ARGS)
+def _source_digests(src):
+    return sheet_digests(src.data)
+
+
+def identical_sheets(src1, src2, sheets):
+    """Множество листов из `sheets`, сырые данные которых совпадают в обоих файлах."""
+    digests1 = _source_digests(src1)
+    digests2 = _source_digests(src2)
+    return {
+        sheet for sheet in sheets
+        if sheet in digests1 and digests1[sheet] == digests2.get(sheet)
+    }
+
+
+# --- СТРУКТУРА ЛИСТОВ (ДО СРАВНЕНИЯ) ---
+# Перед сравнением ячеек сопоставляются колонки двух листов. Совпадающие по
+# имени колонки сравниваются как есть (порядок не важен). Оставшиеся колонки
+# сопоставляются по похожести имени и по отпечатку значений: хэши уникальных
+# значений колонки, из которых хранятся только FINGERPRINT_SIZE наименьших
+# (оценка доли общих значений без сравнения колонок целиком). Колонки без пары
+# считаются добавленными/удаленными и в карту различий не входят - иначе
+# каждая строка листа попала бы в "Изменено".
+
+FINGERPRINT_SIZE = 256
+RENAME_THRESHOLD = 0.6
+# Значения учитываются, только если в обеих колонках не меньше
+# VALUE_MATCH_MIN_DISTINCT разных значений: у колонок вроде Y/N или кодов
+# статуса значения совпадают случайно, и для них решает только имя.
+# Почти совпадающие значения - достаточный признак переименования даже при
+# совсем другом имени.
+VALUE_MATCH_THRESHOLD = 0.8
+VALUE_MATCH_MIN_DISTINCT = 20
+
+_KIND_NAMES = {
+    'integer': 'число', 'floating': 'число', 'mixed-integer-float': 'число', 'decimal': 'число',
+    'boolean': 'логический',
+    'datetime64': 'дата', 'datetime': 'дата', 'date': 'дата',
+    'string': 'текст', 'bytes': 'текст',
+}
+
+
+@dataclass
+class SchemaDrift:
+    pairs: list  # (колонка старого листа, колонка нового листа)
+    renamed: list  # (старое имя, новое имя, оценка сходства)
+    added: list
+    removed: list
+    type_changes: list  # (колонка старого листа, колонка нового листа, тип было, тип стало)
+    key_col: object = None
+    duplicate_keys_old: int = 0
+    duplicate_keys_new: int = 0
+    conflicting_keys_old: int = 0
+    conflicting_keys_new: int = 0
+
+    @property
+    def mapping(self):
+        return dict(self.pairs)
+
+    def messages(self):
+        """Описание расхождений структуры для вывода пользователю."""
+        messages = []
+        for old, new, score in self.renamed:
+            messages.append(f"Колонка '{old}' переименована в '{new}' (сходство {score:.0%}), сравнивается как одна колонка.")
+        if self.added:
+            messages.append(f"Новые колонки во втором файле: {', '.join(map(str, self.added))} (в сравнении не участвуют, показаны в результате).")
+        if self.removed:
+            messages.append(f"Колонки отсутствуют во втором файле: {', '.join(map(str, self.removed))} (в сравнении не участвуют).")
+        for old, new, kind_old, kind_new in self.type_changes:
+            messages.append(f"Колонка '{new}': тип данных изменился ({kind_old} → {kind_new}).")
+        if self.duplicate_keys_old or self.duplicate_keys_new:
+            messages.append(
+                f"Дубли ключа '{self.key_col}': в старом файле {self.duplicate_keys_old} "
+                f"(с разными данными {self.conflicting_keys_old}), в новом {self.duplicate_keys_new} "
+                f"(с разными данными {self.conflicting_keys_new}). Сравнение идет с первым вхождением."
+            )
+        return messages
+
+
+def _value_kind(series):
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind == 'empty':
+        return None
+    return _KIND_NAMES.get(kind, 'смешанный')
+
+
+def _name_similarity(a, b):
+    def norm(name):
+        return re.sub(r'[\s_\-.]+', ' ', str(name)).strip().lower()
+    return difflib.SequenceMatcher(None, norm(a), norm(b)).ratio()
+
+
+def _fingerprint(series):
+    # Наименьшие хэши уникальных значений (bottom-k): по двум таким наборам
+    # оценивается доля общих значений колонок
+    values = series.dropna()
+    if values.empty:
+        return np.empty(0, dtype=np.uint64)
+    hashes = pd.util.hash_pandas_object(values.astype(str), index=False).to_numpy()
+    return np.unique(hashes)[:FINGERPRINT_SIZE]
+
+
+def _value_similarity(fp1, fp2):
+    if not len(fp1) or not len(fp2):
+        return 0.0
+    union = np.union1d(fp1, fp2)[:FINGERPRINT_SIZE]
+    return float(np.isin(union, np.intersect1d(fp1, fp2)).mean())
+
+
+def _duplicate_keys(df, key_col):
+    """(ключей с дублями, из них - с разными данными в строках)."""
+    if key_col is None or key_col not in df.columns:
+        return 0, 0
+    keys = _clean_key(df[key_col])
+    dup = (keys.duplicated(keep=False) & (keys != '')).to_numpy()
+    if not dup.any():
+        return 0, 0
+    row_hashes = pd.util.hash_pandas_object(df[dup].astype(str), index=False).to_numpy()
+    per_key = pd.Series(row_hashes).groupby(keys[dup].to_numpy()).nunique()
+    return len(per_key), int((per_key > 1).sum())
+
+
+def analyze_schema(df_old, df_new, key_col=None):
+    """Сопоставление колонок, переименования, смена типов и дубли ключа."""
+    new_columns = set(df_new.columns)
+    pairs = [(c, c) for c in df_old.columns if c in new_columns]
+    removed = [c for c in df_old.columns if c not in new_columns]
+    added = [c for c in df_new.columns if c not in set(df_old.columns)]
+
+    # Переименования: жадно берем лучшие пары среди колонок без совпадения по имени
+    renamed = []
+    if removed and added:
+        fp_old = {c: _fingerprint(df_old[c]) for c in removed}
+        fp_new = {c: _fingerprint(df_new[c]) for c in added}
+        candidates = []
+        for old in removed:
+            for new in added:
+                score = _name_similarity(old, new)
+                if min(len(fp_old[old]), len(fp_new[new])) >= VALUE_MATCH_MIN_DISTINCT:
+                    values = _value_similarity(fp_old[old], fp_new[new])
+                    score = 0.5 * score + 0.5 * values
+                    if values >= VALUE_MATCH_THRESHOLD:
+                        score = max(score, values)
+                candidates.append((score, old, new))
+        candidates.sort(key=lambda item: item[0], reverse=True)
+        for score, old, new in candidates:
+            if score < RENAME_THRESHOLD:
+                break
+            if old in removed and new in added:
+                renamed.append((old, new, score))
+                removed.remove(old)
+                added.remove(new)
+        # Пары - в порядке колонок старого листа
+        renamed_to = {old: new for old, new, _ in renamed}
+        pairs = [(c, c if c in new_columns else renamed_to[c]) for c in df_old.columns
+                 if c in new_columns or c in renamed_to]
+
+    type_changes = []
+    for old, new in pairs:
+        kind_old, kind_new = _value_kind(df_old[old]), _value_kind(df_new[new])
+        if kind_old and kind_new and kind_old != kind_new:
+            type_changes.append((old, new, kind_old, kind_new))
+
+    new_key_col = dict(pairs).get(key_col, key_col)
+    duplicate_keys_old, conflicting_keys_old = _duplicate_keys(df_old, key_col)
+    duplicate_keys_new, conflicting_keys_new = _duplicate_keys(df_new, new_key_col)
+
+    return SchemaDrift(
+        pairs=pairs,
+        renamed=renamed,
+        added=added,
+        removed=removed,
+        type_changes=type_changes,
+        key_col=key_col,
+        duplicate_keys_old=duplicate_keys_old,
+        duplicate_keys_new=duplicate_keys_new,
+        conflicting_keys_old=conflicting_keys_old,
+        conflicting_keys_new=conflicting_keys_new,
+    )
+
+
+# --- ЕДИНЫЙ ДВИЖОК СРАВНЕНИЯ ---
+# Один проход по разобранным (и закэшированным) данным дает все виды отчетов:
+# построчные изменения (app.py, app2.0.py), новые/измененные/удаленные строки
+# по ключу (app2.2.py) и их отфильтрованные по значениям подмножества (app2.3.py).
+#
+# Результат сравнения хранит побитовую карту различий (строка x колонка).
+# Смена игнорируемых колонок - это только свертка карты по оставшимся колонкам,
+# а смена фильтра - только новая маска по закэшированным новым строкам:
+# без повторного чтения и без повторного сравнения.
+
+STATUS_ADDED = "🟢 Добавлено"
+STATUS_CHANGED = "🟡 Изменено"
+
+# Разобранные листы и результаты сравнения хранятся в одном кэше на процесс,
+# общем для всех сессий: лимит памяти задается один на сервер
+# (EXCEL_APP_CACHE_MB) и покрывает и листы, и копии/карты различий внутри
+# результатов; холодные записи выгружаются на диск (EXCEL_APP_CACHE_DIR,
+# EXCEL_APP_DISK_CACHE_MB). Движок не изменяет закэшированные объекты,
+# поэтому они отдаются без копирования.
+@st.cache_resource(show_spinner=False)
+def _sheet_cache():
+    return sheet_cache.from_environment()
+
+
+def _session_id():
+    return st.session_state.setdefault('_session_id', uuid.uuid4().hex)
+
+
+def _read_sheet(data, sheet_name):
+    return pd.read_excel(io.BytesIO(data), sheet_name=sheet_name)
+
+
+def load_sheet(src, sheet_name):
+    """Полностью читает лист. Результат кэшируется по содержимому файла (общий кэш всех сессий)."""
+    return _sheet_cache().get(
+        (src.digest, sheet_name),
+        lambda: _read_sheet(src.data, sheet_name),
+        session_id=_session_id()
+    )
+
+
+def _cached_result(key, compute):
+    # key[0] - кортеж хэшей сравниваемых файлов: по нему сессия отпускает результат
+    return _sheet_cache().get(key, compute, session_id=_session_id())
+
+
+def cache_metrics():
+    """Попадания/промахи/выгрузки общего кэша листов."""
+    return _sheet_cache().metrics()
+
+
+@dataclass
+class SheetComparison:
+    rows_old: int
+    rows_new: int
+    # Построчное сравнение: выровненные листы и карта различий по колонкам
+    left: pd.DataFrame
+    right: pd.DataFrame
+    diff_columns: list
+    diff_bitmap: np.ndarray
+    # Сравнение по ключу (пустые, если ключ не задан)
+    key_col: object = None
+    added: pd.DataFrame = field(default_factory=pd.DataFrame)
+    deleted: pd.DataFrame = field(default_factory=pd.DataFrame)
+    matched: pd.DataFrame = field(default_factory=pd.DataFrame)
+    matched_columns: list = field(default_factory=list)
+    matched_bitmap: np.ndarray = field(default_factory=lambda: np.zeros((0, 0), dtype=bool))
+    warnings: list = field(default_factory=list)
+    # Сопоставление колонок, по которому выровнены оба сравнения
+    schema: SchemaDrift = None
+
+    def positional(self, ignored=()):
+        """Status + пары колонок {col}_Day1 / {col}_Day2 для новых и измененных строк."""
+        changed = _reduce(self.diff_bitmap, self.diff_columns, ignored)
+        return _positional_frame(self.left, self.right, np.flatnonzero(changed), self.schema.pairs)
+
+    def changed(self, ignored=()):
+        """Строки нового файла, ключ которых есть в старом, а значения отличаются."""
+        return self.matched[_reduce(self.matched_bitmap, self.matched_columns, ignored)]
+
+    def new_rows(self, filter_col=None, filter_values=None, drop_cols=None):
+        """Новые строки по ключу с необязательным фильтром по значениям и удалением колонок."""
+        rows = self.added
+        if filter_col is not None and filter_values:
+            rows = filter_by_values(rows, filter_col, filter_values)
+        if drop_cols:
+            rows = rows.drop(columns=[c for c in drop_cols if c in rows.columns])
+        return rows
+
+
+def _reduce(bitmap, columns, ignored):
+    # Строка изменена, если отличается хотя бы одна НЕ игнорируемая колонка
+    keep = [i for i, c in enumerate(columns) if c not in ignored]
+    if not keep:
+        return np.zeros(len(bitmap), dtype=bool)
+    return bitmap[:, keep].any(axis=1)
+
+
+def filter_by_values(df, filter_col, filter_values):
+    # Сравниваем как строки, чтобы значения из выпадающего списка точно совпадали
+    values_str = [str(v) for v in filter_values]
+    column_str = df[filter_col].astype(str)
+    result = df[column_str.isin(values_str)].copy()
+    result[filter_col] = column_str.loc[result.index]
+    return result
+
+
+def unique_values(df, col):
+    """Отсортированные уникальные значения колонки (строками) для фильтров."""
+    values = [str(x) for x in df[col].dropna().unique()]
+    values.sort()
+    return values
+
+
+def _clean_key(series):
+    # Приводим ключ к строке и убираем NaN
+    return series.astype(str).replace('nan', '')
+
+
+def _as_date(value):
+    try:
+        d = pd.to_datetime(value, errors='coerce')
+    except Exception:
+        return None
+    return d.date() if pd.notna(d) else None
+
+
+def _column_diff(left, right, compare_dates):
+    """Маска различий двух выровненных колонок (как str(val1) != str(val2))."""
+    left_str = left.map(str).to_numpy()
+    right_str = right.map(str).to_numpy()
+    diff = left_str != right_str
+    if compare_dates:
+        # Если оба значения - даты, сравниваем только дату (без времени)
+        left_dates = left.map(_as_date).to_numpy()
+        right_dates = right.map(_as_date).to_numpy()
+        both_dates = pd.notna(left_dates) & pd.notna(right_dates)
+        diff = np.where(both_dates, left_dates != right_dates, diff)
+    return diff
+
+
+def _compare_dates(df1, old, df2, new, ignore_time_in_dates):
+    # Время отбрасывается только в колонках дат (в любом из двух файлов)
+    return ignore_time_in_dates and (
+        pd.api.types.is_datetime64_any_dtype(df1[old])
+        or pd.api.types.is_datetime64_any_dtype(df2[new])
+    )
+
+
+def _positional_bitmap(df1, df2, ignore_time_in_dates, pairs):
+    # Сравниваются только сопоставленные колонки; карта подписана именами старого листа
+    n = min(len(df1), len(df2))
+    columns = [old for old, _ in pairs]
+
+    bitmap = np.zeros((n, len(columns)), dtype=bool)
+    for j, (old, new) in enumerate(pairs):
+        left = df1[old].iloc[:n].reset_index(drop=True)
+        right = df2[new].iloc[:n].reset_index(drop=True)
+        bitmap[:, j] = _column_diff(left, right, _compare_dates(df1, old, df2, new, ignore_time_in_dates))
+    return columns, bitmap
+
+
+def _positional_part(df1, df2, idx, status, mapping, added_cols):
+    part = {'Status': status}
+    for col in df1.columns:
+        part[f"{col}_Day1"] = df1[col].to_numpy()[idx] if status == STATUS_CHANGED else ''
+        part[f"{col}_Day2"] = df2[mapping[col]].to_numpy()[idx] if col in mapping else ''
+    # Колонки, появившиеся только во втором файле
+    for col in added_cols:
+        part[f"{col}_Day1"] = ''
+        part[f"{col}_Day2"] = df2[col].to_numpy()[idx]
+    return pd.DataFrame(part, index=range(len(idx)))
+
+
+def _positional_frame(df1, df2, changed_idx, pairs):
+    added_idx = np.arange(len(df1), len(df2))
+    mapping = dict(pairs)
+    paired_new = set(mapping.values())
+    added_cols = [col for col in df2.columns if col not in paired_new]
+
+    # Измененные строки: в результат пишем ВСЕ колонки, хотя сравнивали только неигнорируемые
+    # (переименованная колонка выводится под старым именем)
+    parts = []
+    if len(changed_idx):
+        parts.append(_positional_part(df1, df2, changed_idx, STATUS_CHANGED, mapping, added_cols))
+    # Новые строки: во втором файле строк больше, чем в первом
+    if len(added_idx):
+        parts.append(_positional_part(df1, df2, added_idx, STATUS_ADDED, mapping, added_cols))
+
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True)
+
+
+def _keyed_diff(df_old, df_new, key_col, pairs, ignore_time_in_dates=False):
+    # Ключевая колонка могла быть переименована во втором файле
+    new_key_col = dict(pairs).get(key_col, key_col)
+    old_keys = _clean_key(df_old[key_col])
+    new_keys = _clean_key(df_new[new_key_col])
+
+    in_old = new_keys.isin(old_keys).to_numpy()
+    in_new = old_keys.isin(new_keys).to_numpy()
+
+    added = df_new[~in_old].copy()
+    added[new_key_col] = new_keys[~in_old]
+    deleted = df_old[~in_new].copy()
+    deleted[key_col] = old_keys[~in_new]
+
+    # Измененные: ключ есть в обоих файлах, а значения общих колонок отличаются.
+    # При дублях ключа в старом файле сравниваем с первым вхождением.
+    matched = df_new[in_old].copy()
+    matched[new_key_col] = new_keys[in_old]
+    old_first = df_old.assign(**{'__key__': old_keys}).drop_duplicates('__key__').set_index('__key__')
+    base = old_first.reindex(new_keys[in_old].to_numpy())
+    common = [(old, new) for old, new in pairs if old != key_col]
+
+    bitmap = np.zeros((len(matched), len(common)), dtype=bool)
+    for j, (old, new) in enumerate(common):
+        left = base[old].fillna('').reset_index(drop=True)
+        right = df_new.loc[in_old, new].fillna('').reset_index(drop=True)
+        bitmap[:, j] = _column_diff(left, right, _compare_dates(df_old, old, df_new, new, ignore_time_in_dates))
+
+    # Карта подписана именами старого листа - как и списки игнорируемых колонок
+    return added, deleted, matched, [old for old, _ in common], bitmap
+
+
+def compare_frames(df_old, df_new, key_col=None, sort_col=None, ignore_time_in_dates=False):
+    """Один проход сравнения двух листов: построчно и (если задан ключ) по ключу."""
+    warnings = []
+    # Сначала сопоставляем колонки: добавленные/удаленные не сравниваются по ячейкам,
+    # переименованные сравниваются со своей парой
+    schema = analyze_schema(df_old, df_new, key_col)
+    mapping = schema.mapping
+    df1 = df_old.fillna('')
+    df2 = df_new.fillna('')
+
+    # Сортируем оба датафрейма по выбранной колонке, чтобы выровнять строки
+    if sort_col is not None:
+        try:
+            df1 = df1.sort_values(by=sort_col)
+            df2 = df2.sort_values(by=mapping.get(sort_col, sort_col))
+        except Exception as e:
+            warnings.append(f"Не удалось отсортировать по колонке '{sort_col}'. Сравнение может быть неточным. Ошибка: {e}")
+    df1 = df1.reset_index(drop=True)
+    df2 = df2.reset_index(drop=True)
+
+    diff_columns, diff_bitmap = _positional_bitmap(df1, df2, ignore_time_in_dates, schema.pairs)
+    result = SheetComparison(
+        rows_old=len(df_old),
+        rows_new=len(df_new),
+        left=df1,
+        right=df2,
+        diff_columns=diff_columns,
+        diff_bitmap=diff_bitmap,
+        key_col=key_col,
+        warnings=warnings,
+        schema=schema,
+    )
+    if key_col is not None and key_col not in schema.mapping:
+        # Ключа нет в одном из файлов: построчное сравнение остается, сравнение по ключу пропускаем
+        warnings.append(f"Колонка-ключ '{key_col}' есть не в обоих файлах. Сравнение по ключу пропущено.")
+        result.key_col = None
+    elif key_col is not None:
+        (result.added, result.deleted, result.matched,
+         result.matched_columns, result.matched_bitmap) = _keyed_diff(
+            df_old, df_new, key_col, schema.pairs, ignore_time_in_dates)
+    return result
+
+
+def compare_sheets(src_old, src_new, sheet_old, sheet_new, key_col=None, sort_col=None,
+                   ignore_time_in_dates=False):
+    """Сравнение листов двух файлов; разбор и результат кэшируются (общий кэш всех сессий).
+
+    Игнорируемые колонки и фильтры сюда не входят - они применяются к
+    результату (SheetComparison.positional / changed / new_rows).
+    """
+    def compare():
+        df_old = load_sheet(src_old, sheet_old)
+        df_new = load_sheet(src_new, sheet_new)
+        return compare_frames(df_old, df_new, key_col, sort_col, ignore_time_in_dates)
+
+    key = ((src_old.digest, src_new.digest), 'compare', sheet_old, sheet_new, key_col, sort_col, ignore_time_in_dates)
+    return _cached_result(key, compare)
+
+
+# --- ОДИН НОВЫЙ ФАЙЛ ПРОТИВ НЕСКОЛЬКИХ СТАРЫХ ---
+# Новый файл разбирается один раз, индекс ключей и хэши ячеек строятся один раз.
+# Старые файлы (предыдущий день, конец недели, конец месяца...), которых еще нет
+# в общем кэше листов, разбираются параллельно в отдельных процессах: разбор
+# xlsx занимает одно ядро, поэтому потоки здесь не помогли бы. Процесс-обработчик
+# только читает лист и возвращает его; лист сразу попадает в общий кэш (и в его
+# лимит памяти), а сравнение идет в основном процессе. Новый лист в обработчики
+# не передается, поэтому его копий по числу процессов нет; вне лимита остается
+# только лист, который обработчик в этот момент читает. Сравнение по ключу идет
+# по 64-битным хэшам строкового представления ячеек - тот же критерий, что
+# str(val1) != str(val2).
+
+STATUS_DELETED = "🔴 Удалено"
+
+
+def _cell_hashes(series):
+    return pd.util.hash_array(series.fillna('').map(str).to_numpy(dtype=object))
+
+
+@dataclass
+class KeyIndex:
+    key_col: object
+    keys: np.ndarray  # очищенные ключи нового листа (строки)
+    columns: list
+    hashes: np.ndarray  # хэши ячеек: строка x колонка
+    duplicate_keys: int = 0
+    conflicting_keys: int = 0
+
+
+def build_key_index(df_new, key_col):
+    """Индекс ключей и хэши ячеек нового листа (строятся один раз на все сравнения)."""
+    columns = list(df_new.columns)
+    hashes = np.empty((len(df_new), len(columns)), dtype=np.uint64)
+    for j, col in enumerate(columns):
+        hashes[:, j] = _cell_hashes(df_new[col])
+    duplicate_keys, conflicting_keys = _duplicate_keys(df_new, key_col)
+    return KeyIndex(
+        key_col=key_col,
+        keys=_clean_key(df_new[key_col]).to_numpy(dtype=object),
+        columns=columns,
+        hashes=hashes,
+        duplicate_keys=duplicate_keys,
+        conflicting_keys=conflicting_keys,
+    )
+
+
+@dataclass
+class BaselineResult:
+    label: str
+    rows_old: int = 0
+    schema: SchemaDrift = None
+    added_idx: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    # Строки нового листа, ключ которых есть в старом, и карта различий по колонкам (имена нового листа)
+    matched_idx: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    matched_columns: list = field(default_factory=list)
+    matched_bitmap: np.ndarray = field(default_factory=lambda: np.zeros((0, 0), dtype=bool))
+    # Удаленные строки старого листа (сопоставленные колонки под именами нового листа)
+    deleted: pd.DataFrame = field(default_factory=pd.DataFrame)
+    error: str = None
+
+
+def _diff_baseline(label, df_old, df_new, index):
+    schema = analyze_schema(df_old, df_new)
+    to_old = {new: old for old, new in schema.pairs}
+    old_key = to_old.get(index.key_col)
+    if old_key is None:
+        return BaselineResult(label, rows_old=len(df_old), schema=schema,
+                              error=f"В старом файле нет колонки-ключа '{index.key_col}'.")
+    schema.key_col = old_key
+    schema.duplicate_keys_old, schema.conflicting_keys_old = _duplicate_keys(df_old, old_key)
+    schema.duplicate_keys_new, schema.conflicting_keys_new = index.duplicate_keys, index.conflicting_keys
+
+    old_keys = _clean_key(df_old[old_key]).to_numpy(dtype=object)
+    in_old = pd.Index(index.keys).isin(old_keys)
+    in_new = pd.Index(old_keys).isin(index.keys)
+
+    # При дублях ключа в старом файле сравниваем с первым вхождением
+    first = ~pd.Series(old_keys).duplicated().to_numpy()
+    matched_idx = np.flatnonzero(in_old)
+    old_rows = np.flatnonzero(first)[pd.Index(old_keys[first]).get_indexer(index.keys[matched_idx])]
+
+    common = [(old, new) for old, new in schema.pairs if old != old_key]
+    positions = {col: j for j, col in enumerate(index.columns)}
+    bitmap = np.zeros((len(matched_idx), len(common)), dtype=bool)
+    for k, (old, new) in enumerate(common):
+        bitmap[:, k] = _cell_hashes(df_old[old]).take(old_rows) != index.hashes[matched_idx, positions[new]]
+
+    deleted = df_old[~in_new][[old for old, _ in schema.pairs]].rename(columns=dict(schema.pairs))
+    deleted[index.key_col] = old_keys[~in_new]
+
+    return BaselineResult(
+        label,
+        rows_old=len(df_old),
+        schema=schema,
+        added_idx=np.flatnonzero(~in_old),
+        matched_idx=matched_idx,
+        matched_columns=[new for _, new in common],
+        matched_bitmap=bitmap,
+        deleted=deleted,
+    )
+
+
+def _diff_baselines(baselines, df_new, index, parsed):
+    # parsed - {(хэш файла, лист): Future} для листов, которые читают процессы-обработчики
+    results = []
+    for label, src, sheet in baselines:
+        key = (src.digest, sheet)
+        try:
+            if key in parsed:
+                df_old = _sheet_cache().get(key, parsed[key].result, session_id=_session_id())
+            else:
+                df_old = load_sheet(src, sheet)
+            results.append(_diff_baseline(label, df_old, df_new, index))
+        except Exception as e:
+            results.append(BaselineResult(label, error=str(e)))
+    return results
+
+
+def _free_name(name, taken):
+    # Имя колонки, которого еще нет среди taken: "Статус", "Статус (сравнение)", "Статус (сравнение 2)"...
+    candidate, n = name, 1
+    while candidate in taken:
+        candidate = f"{name} (сравнение)" if n == 1 else f"{name} (сравнение {n})"
+        n += 1
+    return candidate
+
+
+@dataclass
+class BatchComparison:
+    key_col: object
+    rows_new: int
+    new: pd.DataFrame
+    index: KeyIndex
+    baselines: list
+
+    def _changed(self, result, ignored):
+        changed = _reduce(result.matched_bitmap, result.matched_columns, ignored)
+        # Какие колонки изменились в каждой строке (кроме игнорируемых)
+        keep = np.array([c not in ignored for c in result.matched_columns], dtype=bool)
+        names = np.array([str(c) for c in result.matched_columns], dtype=object)
+        per_row = [', '.join(names[row & keep]) for row in result.matched_bitmap[changed]]
+        return result.matched_idx[changed], per_row
+
+    def summary(self, ignored=()):
+        """Одна строка на старый файл: сколько новых, измененных и удаленных строк."""
+        rows = []
+        for result in self.baselines:
+            if result.error:
+                rows.append({'База': result.label, 'Строк в базе': result.rows_old, 'Ошибка': result.error})
+                continue
+            changed_idx, _ = self._changed(result, ignored)
+            rows.append({
+                'База': result.label,
+                'Строк в базе': result.rows_old,
+                STATUS_ADDED: len(result.added_idx),
+                STATUS_CHANGED: len(changed_idx),
+                STATUS_DELETED: len(result.deleted),
+            })
+        return pd.DataFrame(rows)
+
+    def combined(self, ignored=()):
+        """Все изменения нового файла относительно каждой базы в одной таблице."""
+        # Служебные колонки не должны совпасть с колонками листа (в нем может быть своя "Статус")
+        taken = {str(c) for c in self.index.columns}
+        for result in self.baselines:
+            taken.update(str(c) for c in result.deleted.columns)
+        base_col, status_col, detail_col = (_free_name(name, taken) for name in ('База', 'Статус', 'Изменены колонки'))
+
+        parts = []
+        for result in self.baselines:
+            if result.error:
+                continue
+            changed_idx, changed_cols = self._changed(result, ignored)
+            for status, rows, detail in (
+                (STATUS_ADDED, self._new_rows(result.added_idx), ''),
+                (STATUS_CHANGED, self._new_rows(changed_idx), changed_cols),
+                (STATUS_DELETED, result.deleted, ''),
+            ):
+                if len(rows):
+                    rows = rows.reset_index(drop=True)
+                    rows.insert(0, detail_col, detail)
+                    rows.insert(0, status_col, status)
+                    rows.insert(0, base_col, result.label)
+                    parts.append(rows)
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat(parts, ignore_index=True)
+
+    def _new_rows(self, idx):
+        rows = self.new.iloc[idx].copy()
+        rows[self.key_col] = self.index.keys[idx]
+        return rows
+
+
+def compare_batch(src_new, sheet_new, key_col, baselines):
+    """Сравнение нового листа с несколькими старыми: baselines - кортеж (подпись, SourceFile, лист).
+
+    Игнорируемые колонки сюда не входят - они применяются к результату
+    (BatchComparison.summary / combined). Результат кэшируется в общем кэше.
+    """
+    key = (
+        (src_new.digest, *(src.digest for _, src, _ in baselines)),
+        'batch', sheet_new, key_col, tuple((label, sheet) for label, _, sheet in baselines),
+    )
+    return _cached_result(key, lambda: _compare_batch(src_new, sheet_new, key_col, baselines))
+
+
+def _compare_batch(src_new, sheet_new, key_col, baselines):
+    df_new = load_sheet(src_new, sheet_new)
+    index = build_key_index(df_new, key_col)
+
+    cache = _sheet_cache()
+    to_parse = {(src.digest, sheet): src for _, src, sheet in baselines if (src.digest, sheet) not in cache}
+    if len(to_parse) > 1:
+        # spawn: форк процесса Streamlit с работающими потоками небезопасен
+        with ProcessPoolExecutor(
+            max_workers=min(len(to_parse), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context('spawn'),
+        ) as pool:
+            parsed = {key: pool.submit(_read_sheet, src.data, key[1]) for key, src in to_parse.items()}
+            results = _diff_baselines(baselines, df_new, index, parsed)
+    else:
+        # Один лист для разбора (или все уже в кэше) - без запуска отдельных процессов
+        results = _diff_baselines(baselines, df_new, index, {})
+
+    return BatchComparison(key_col=key_col, rows_new=len(df_new), new=df_new, index=index, baselines=results)
+
+
+# --- БЫСТРАЯ ОЦЕНКА ПО ВЫБОРКЕ ---
+# Прежде чем запускать точное сравнение большого файла, можно оценить масштаб
+# изменений. XML листа распаковывается потоком, кусками по _CHUNK_SIZE, и в
+# памяти целиком не хранится. На каждом куске выполняются только поиски по
+# байтам (rfind/find), регулярные выражения запускаются лишь на кусках с
+# выбранными блоками строк. Исключение - колонка-ключ: она извлекается из
+# всего листа одним регулярным выражением, поэтому новые/удаленные ключи
+# считаются точно.
+#
+# Чтобы оценка сходилась с точным сравнением, данные читаются так, как их
+# видит read_excel: заголовки - тем же путем, что и sheet_columns; строки
+# сопоставляются по номеру строки Excel (r="..."), пустые строки не
+# пропускаются; числа выводятся как str() значения колонки, а колонка с
+# пропусками или дробными числами считается float64 (целое 1 -> "1.0").
+# Тип колонки определяется по прочитанным строкам (для ключа - по всей колонке).
+
+_CHUNK_SIZE = 1 << 20
+
+_ROW_START_RE = re.compile(rb'<(?:\w+:)?row\b[^>]*?\sr="(\d+)"')
+_ROW_TAG_RE = re.compile(rb'<(?:\w+:)?row\b')
+_CELL_TAG_RE = re.compile(rb'<(?:\w+:)?c\b')
+_SHEET_DATA_RE = re.compile(rb'<(?:\w+:)?sheetData\b[^>]*?(/?)>')
+_DIMENSION_RE = re.compile(rb'<(?:\w+:)?dimension\b[^>]*?\sref="[A-Z]*(\d+)(?::[A-Z]*(\d+))?"')
+# Ячейка с адресом первым атрибутом (так пишут Excel и openpyxl): буквы колонки, прочие атрибуты, содержимое
+_CELL_BY_REF_RE = re.compile(rb'<(?:\w+:)?c\b(?:\s+r="([A-Z]+)\d*")?([^>]*?)(?:/>|>(.*?)</(?:\w+:)?c>)', re.S)
+_VALUE_RE = re.compile(rb'<(?:\w+:)?v>(.*?)</(?:\w+:)?v>', re.S)
+_TEXT_RE = re.compile(rb'<(?:\w+:)?t\b[^>]*>(.*?)</(?:\w+:)?t>', re.S)
+_PHONETIC_RE = re.compile(rb'<(?:\w+:)?rPh\b.*?</(?:\w+:)?rPh>', re.S)
+_SHARED_VALUE_RE = re.compile(rb't="s"[^>]*>\s*<(?:\w+:)?v>(\d+)</')
+_SI_END_RE = re.compile(rb'</(?:\w+:)?si>|<(?:\w+:)?si\b[^>]*/>')
+
+# Встроенные форматы чисел Excel, которые openpyxl читает как даты/время
+_DATE_FORMAT_IDS = set(range(14, 23)) | set(range(27, 37)) | set(range(45, 48)) | set(range(50, 59))
+
+# Строки, которые read_excel по умолчанию считает пустыми (na_values)
+_NA_TEXTS = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+}
+
+Z_95 = 1.96
+
+
+def read_columns(file_bytes, sheet_name):
+    """Заголовки листа так, как их назовет read_excel (читается только первая строка)."""
+    return pd.read_excel(io.BytesIO(file_bytes), sheet_name=sheet_name, nrows=1).columns.tolist()
+
+
+def _column_index(letters):
+    index = 0
+    for ch in letters:
+        index = index * 26 + (ord(ch) - 64)
+    return index - 1
+
+
+def _column_letters(index):
+    letters = b''
+    n = index + 1
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = bytes([65 + rem]) + letters
+    return letters
+
+
+def _attribute(attrs, prefix):
+    # Значение атрибута по префиксу вида b' t="' (поиск по байтам, без регулярных выражений)
+    start = attrs.find(prefix)
+    if start < 0:
+        return None
+    start += len(prefix)
+    return attrs[start:attrs.find(b'"', start)]
+
+
+def _number_text(raw, as_float=False):
+    # Как str() значения после read_excel: целые числа pandas отдает как int,
+    # но в колонке float64 они печатаются с ".0"
+    if not as_float and raw.isdigit():
+        return raw
+    try:
+        value = float(raw)
+    except ValueError:
+        return raw
+    if not as_float and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _cell_text(cell, as_float):
+    kind, value = cell
+    if kind == 'num':
+        return _number_text(value, as_float)
+    if kind == 'date':
+        return 'date:' + _number_text(value)
+    return value
+
+
+def _float64_columns(cells_by_row, n_rows):
+    """Колонки, которые read_excel прочитает как float64: только числа, и есть дробные или пропуски."""
+    present = collections.Counter()
+    not_numeric = set()
+    fractional = set()
+    for cells in cells_by_row:
+        for col, (kind, value) in cells.items():
+            present[col] += 1
+            if kind != 'num':
+                not_numeric.add(col)
+            elif col not in fractional and not float(value).is_integer():
+                fractional.add(col)
+    return {
+        col for col, count in present.items()
+        if col not in not_numeric and (col in fractional or count < n_rows)
+    }
+
+
+def _date_styles(zf, styles_part):
+    """Индексы стилей ячеек (s="..."), которые pandas/openpyxl читают как даты."""
+    if not styles_part:
+        return set()
+    try:
+        root = ET.fromstring(zf.read(styles_part))
+    except (KeyError, ET.ParseError):
+        return set()
+    custom = {}
+    for fmt in root.iter(f'{{{NS_MAIN}}}numFmt'):
+        code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', '', fmt.get('formatCode', ''))
+        custom[int(fmt.get('numFmtId', -1))] = bool(re.search(r'[dmyhs]', code, re.I))
+    cell_xfs = root.find(f'{{{NS_MAIN}}}cellXfs')
+    if cell_xfs is None:
+        return set()
+    styles = set()
+    for i, xf in enumerate(cell_xfs.findall(f'{{{NS_MAIN}}}xf')):
+        fmt_id = int(xf.get('numFmtId', 0))
+        if custom.get(fmt_id, fmt_id in _DATE_FORMAT_IDS):
+            styles.add(str(i).encode())
+    return styles
+
+
+def _last_row_start(buf, end=None):
+    # Начало последнего тега <row> до позиции end (0, если его нет)
+    pos = len(buf) if end is None else end
+    while True:
+        pos = buf.rfind(b'row', 0, pos)
+        if pos < 1:
+            return 0
+        lt = buf.rfind(b'<', 0, pos)
+        if lt >= 0 and _ROW_TAG_RE.match(buf, lt):
+            return lt
+
+
+def _last_si_end(buf):
+    # Конец последнего полного элемента <si> в буфере (0, если его нет)
+    pos = len(buf)
+    while True:
+        pos = buf.rfind(b'si', 0, pos)
+        if pos < 1:
+            return 0
+        lt = buf.rfind(b'<', 0, pos)
+        m = _SI_END_RE.match(buf, lt) if lt >= 0 else None
+        if m and m.end() > pos:
+            return m.end()
+
+
+def _read_shared(zf, part, needed):
+    """Тексты общих строк с индексами из needed; таблица читается потоком.
+
+    Куски без нужных индексов не разбираются: элементы <si> в них только считаются.
+    """
+    found = {}
+    if not part or not needed:
+        return found
+    wanted = sorted(needed)
+    index = 0
+    buf = b''
+    with zf.open(part) as f:
+        while index <= wanted[-1]:
+            chunk = f.read(_CHUNK_SIZE)
+            buf += chunk
+            cut = _last_si_end(buf)
+            if cut:
+                count = len(_SI_END_RE.findall(buf, 0, cut))
+                lo = bisect.bisect_left(wanted, index)
+                if lo < len(wanted) and wanted[lo] < index + count:
+                    for m in _SI_RE.finditer(buf, 0, cut):
+                        if index in needed:
+                            found[index] = _shared_text(m.group(0))
+                        index += 1
+                else:
+                    index += count
+                buf = buf[cut:]
+            if not chunk:
+                break
+    return found
+
+
+def _shared_text(item):
+    item = _PHONETIC_RE.sub(b'', item)
+    return html.unescape(b''.join(_TEXT_RE.findall(item)).decode('utf-8'))
+
+
+class _SheetScan:
+    """Потоковое чтение листа xlsx для быстрой оценки.
+
+    scan() за один проход по XML находит номер последней строки со значением,
+    собирает ячейки колонки-ключа и сырой XML нужных строк; с collect=False
+    только дочитывает недостающие строки. Нумерация как в pandas: строка 1 -
+    заголовок, строка данных i - это r = i + 2.
+    """
+
+    def __init__(self, file_bytes, sheet_name, header=None):
+        self._file_bytes = file_bytes
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+            _, sheets, self._shared_part, styles_part = _workbook_parts(zf)
+            self._part = dict(sheets)[sheet_name]
+            self._date_styles = _date_styles(zf, styles_part)
+        self.header = list(header) if header is not None else read_columns(file_bytes, sheet_name)
+        self.dimension = None
+        self.last_row = 1
+        self.rows = {}  # r -> сырой XML строки
+        self._requested = set()
+        self._keys = []  # [(r, атрибуты, значение <v>, прочее содержимое)] ячеек колонки-ключа
+        self._keys_resolved = False
+        self._key_float = {}  # колонка-ключ -> float64 ли она (по всей колонке)
+        self._formats = {}  # атрибуты ячейки без r="..." -> (тип, дата ли)
+        self._shared = {}
+        self._cells = {}  # r -> {индекс_колонки: (вид, значение)}
+        self._float_cols = None
+
+    @property
+    def n_rows(self):
+        return self.last_row - 1
+
+    def label(self, col):
+        # Колонки правее заголовка read_excel называет "Unnamed: N"
+        return self.header[col] if col < len(self.header) else f"Unnamed: {col}"
+
+    def _segments(self):
+        # Куски XML между <sheetData> и </sheetData>, разрезанные по границам <row>
+        with zipfile.ZipFile(io.BytesIO(self._file_bytes)) as zf, zf.open(self._part) as f:
+            buf = b''
+            started = False
+            while True:
+                chunk = f.read(_CHUNK_SIZE)
+                buf += chunk
+                if not started:
+                    m = _SHEET_DATA_RE.search(buf)
+                    if m is None:
+                        if not chunk:
+                            return
+                        continue
+                    dimension = _DIMENSION_RE.search(buf, 0, m.start())
+                    if dimension:
+                        self.dimension = int(dimension.group(2) or dimension.group(1))
+                    if m.group(1):
+                        return
+                    buf = buf[m.end():]
+                    started = True
+                end = buf.find(b'sheetData>')
+                if end >= 0:
+                    yield buf[:buf.rfind(b'<', 0, end)]
+                    return
+                if not chunk:
+                    yield buf
+                    return
+                cut = _last_row_start(buf)
+                if cut > 0:
+                    yield buf[:cut]
+                    buf = buf[cut:]
+
+    def read_dimension(self):
+        """Число строк по <dimension> (без чтения данных); None, если его нет."""
+        for _ in self._segments():
+            break
+        return self.dimension
+
+    def scan(self, wanted=(), key_col=None, collect=True):
+        wanted = sorted(set(wanted))
+        wanted_set = set(wanted)
+        self._requested.update(wanted)
+        self._cells = {}
+        self._float_cols = None
+        key_re = key_re_general = None
+        if collect:
+            self.last_row = 1
+            self._keys = []
+            self._keys_resolved = False
+            if key_col is not None:
+                # Группы: номер строки, прочие атрибуты, значение <v> (если это все содержимое), остальное содержимое
+                ref = (rb'r="' + _column_letters(key_col) + rb'(\d+)"([^>]*?)'
+                       rb'(?:/>|>(?:<(?:\w+:)?v>([^<]*)</(?:\w+:)?v>)?(.*?)</(?:\w+:)?c>)')
+                # Поиск, начинающийся с литерала r="B, в разы быстрее разбора каждого тега <c>;
+                # он годится, если адрес - первый атрибут ячейки (проверяется на первом куске)
+                key_re = re.compile(ref, re.S)
+                general_key_re = re.compile(rb'<(?:\w+:)?c\b([^>]*?)\s' + ref, re.S)
+
+        first_segment = True
+        for seg in self._segments():
+            if first_segment:
+                first_segment = False
+                if len(_ROW_TAG_RE.findall(seg)) != len(_ROW_START_RE.findall(seg)):
+                    raise ValueError("строки листа без атрибута r не поддерживаются быстрой оценкой")
+                if key_re is not None and seg.count(b'c r="') != len(_CELL_TAG_RE.findall(seg)):
+                    key_re = None
+                    key_re_general = general_key_re
+
+            if collect:
+                if key_re is not None:
+                    self._keys.extend(key_re.findall(seg))
+                elif key_re_general is not None:
+                    self._keys.extend((rn, before + after, value, rest) for before, rn, after, value, rest in key_re_general.findall(seg))
+                # Последняя строка со значением: read_excel отбрасывает пустые строки в конце листа
+                pos = max(seg.rfind(b'</v>'), seg.rfind(b':v>'), seg.rfind(b'</t>'), seg.rfind(b':t>'))
+                if pos >= 0:
+                    row = _ROW_START_RE.match(seg, _last_row_start(seg, pos))
+                    if row:
+                        self.last_row = max(self.last_row, int(row.group(1)))
+
+            if wanted:
+                # Ячейки разбираются только в кусках, где есть нужные строки
+                first = _ROW_START_RE.search(seg)
+                last = _ROW_START_RE.match(seg, _last_row_start(seg))
+                if first and last:
+                    lo = bisect.bisect_left(wanted, int(first.group(1)))
+                    hi = bisect.bisect_right(wanted, int(last.group(1)))
+                    if first.group(0).startswith(b'<row r="'):
+                        # Обычная запись строк: каждая нужная строка ищется поиском по байтам
+                        pos = 0
+                        for r in wanted[lo:hi]:
+                            start = seg.find(b'<row r="%d"' % r, pos)
+                            if start >= 0:
+                                end = seg.find(b'<row ', start + 1)
+                                self.rows[r] = seg[start:end if end >= 0 else len(seg)]
+                                pos = start
+                    elif lo < hi:
+                        starts = [(m.start(), int(m.group(1))) for m in _ROW_START_RE.finditer(seg)]
+                        for i, (pos, r) in enumerate(starts):
+                            if r in wanted_set:
+                                end = starts[i + 1][0] if i + 1 < len(starts) else len(seg)
+                                self.rows[r] = seg[pos:end]
+
+    def resolve_shared(self):
+        """Дочитывает тексты общих строк, на которые ссылаются прочитанные ячейки."""
+        needed = set()
+        needed.update(map(int, _SHARED_VALUE_RE.findall(b''.join(self.rows.values()))))
+        formats = self._formats
+        for _, attrs, value, rest in self._keys if not self._keys_resolved else ():
+            if (formats.get(attrs) or self._format(attrs))[0] == b's':
+                value = value or _VALUE_RE.search(rest)
+                if value:
+                    needed.add(int(value if isinstance(value, bytes) else value.group(1)))
+        self._keys_resolved = True
+        needed -= self._shared.keys()
+        if needed:
+            with zipfile.ZipFile(io.BytesIO(self._file_bytes)) as zf:
+                self._shared.update(_read_shared(zf, self._shared_part, needed))
+            self._cells = {}
+
+    def _format(self, attrs):
+        # Разных наборов атрибутов (без адреса) в листе немного - разбираем каждый один раз
+        fmt = self._formats.get(attrs)
+        if fmt is None:
+            cell_type = _attribute(attrs, b' t="') or b'n'
+            fmt = cell_type, cell_type == b'n' and _attribute(attrs, b' s="') in self._date_styles
+            self._formats[attrs] = fmt
+        return fmt
+
+    def _cell(self, attrs, body):
+        """(вид, значение) ячейки: 'num'/'date' - число из XML, 'text' - текст; None - пусто для read_excel."""
+        if not body:
+            return None
+        cell_type, is_date = self._format(attrs)
+        if cell_type == b'inlineStr':
+            text = html.unescape(b''.join(_TEXT_RE.findall(body)).decode('utf-8'))
+        else:
+            value = _VALUE_RE.search(body)
+            if not value:
+                return None
+            raw = value.group(1)
+            if cell_type == b'n':
+                return 'date' if is_date else 'num', raw.decode('ascii')
+            if cell_type == b'b':
+                return 'text', 'True' if raw == b'1' else 'False'
+            if cell_type == b'e':
+                # Ошибки (#N/A, #DIV/0!) read_excel читает как пустые значения
+                return None
+            if cell_type == b's':
+                text = self._shared.get(int(raw), '')
+            else:
+                text = html.unescape(raw.decode('utf-8'))
+        return None if text in _NA_TEXTS else ('text', text)
+
+    def _row_cells(self, r):
+        cells = self._cells.get(r)
+        if cells is None:
+            cells = {}
+            col = -1
+            for letters, attrs, body in _CELL_BY_REF_RE.findall(self.rows.get(r, b'')):
+                if not letters:
+                    # Адрес не первым атрибутом (или его нет - тогда это следующая колонка)
+                    letters = (_attribute(attrs, b' r="') or b'').rstrip(b'0123456789')
+                col = _column_index(letters.decode('ascii')) if letters else col + 1
+                cell = self._cell(attrs, body)
+                if cell is not None:
+                    cells[col] = cell
+            self._cells[r] = cells
+        return cells
+
+    def _float_columns(self):
+        # Тип колонок определяется по всем прочитанным строкам данных (а ключ - по всей колонке)
+        if self._float_cols is None:
+            rows = [r for r in self._requested if 2 <= r <= self.last_row]
+            floats = _float64_columns([self._row_cells(r) for r in rows], len(rows))
+            floats.difference_update(self._key_float)
+            floats.update(col for col, as_float in self._key_float.items() if as_float)
+            self._float_cols = floats
+        return self._float_cols
+
+    def data_row(self, index):
+        """{индекс_колонки: текст} для строки данных index (пустая строка - {})."""
+        floats = self._float_columns()
+        return {col: _cell_text(cell, col in floats) for col, cell in self._row_cells(index + 2).items()}
+
+    def sample_frame(self, positions):
+        """Прочитанные строки данных как DataFrame с заголовками листа (значения - тексты)."""
+        rows = [self.data_row(pos) for pos in positions]
+        return pd.DataFrame([[row.get(i) for i in range(len(self.header))] for row in rows], columns=self.header)
+
+    def keys(self, key_col):
+        """Значения колонки-ключа для всех строк данных (как _clean_key после read_excel)."""
+        cells = [None] * self.n_rows
+        numeric = True
+        fractional = False
+        formats = self._formats
+        for rn, attrs, value, rest in self._keys:
+            pos = int(rn) - 2
+            if not 0 <= pos < self.n_rows:
+                continue
+            if value and not rest and (formats.get(attrs) or self._format(attrs)) == (b'n', False):
+                # Обычное число - без разбора содержимого ячейки
+                cell = 'num', value.decode('ascii')
+            else:
+                cell = self._cell(attrs, b'<v>' + value + b'</v>' + rest if value else rest)
+            if cell is not None:
+                cells[pos] = cell
+                if cell[0] != 'num':
+                    numeric = False
+                elif numeric and not fractional and not cell[1].isdigit() and not float(cell[1]).is_integer():
+                    fractional = True
+        # Правило то же, что в _float64_columns: только числа, и есть дробные или пропуски
+        as_float = numeric and (fractional or None in cells)
+        self._key_float[key_col] = as_float
+        self._float_cols = None
+        return [_cell_text(cell, as_float) if cell is not None else '' for cell in cells]
+
+
+def _wilson_interval(rate, n):
+    denom = 1 + Z_95 ** 2 / n
+    center = (rate + Z_95 ** 2 / (2 * n)) / denom
+    half = Z_95 * math.sqrt(rate * (1 - rate) / n + Z_95 ** 2 / (4 * n * n)) / denom
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def _ratio_interval(hits, totals, blocks_total):
+    """Доля и 95% интервал для блочной (кластерной) выборки: оценка отношением."""
+    k = len(totals)
+    n = sum(totals)
+    if n == 0:
+        return 0.0, 0.0, 1.0
+    rate = sum(hits) / n
+    if k >= blocks_total:
+        # Просмотрены все блоки - оценка точная
+        return rate, rate, rate
+    # Интервал Уилсона по просмотренным строкам - нижняя граница ширины: при
+    # одинаковой доле во всех блоках (например, ни одного изменения в выборке)
+    # кластерная оценка дисперсии равна нулю, хотя изменения вне выборки возможны
+    low, high = _wilson_interval(rate, n)
+    if k >= 2:
+        mean_total = n / k
+        residuals = sum((h - rate * t) ** 2 for h, t in zip(hits, totals))
+        variance = residuals / (k * (k - 1) * mean_total ** 2) * (1 - k / blocks_total)
+        half = Z_95 * math.sqrt(variance)
+        low, high = min(low, rate - half), max(high, rate + half)
+    return rate, max(0.0, low), min(1.0, high)
+
+
+def _duplicated(keys):
+    # Как в _duplicate_keys: число разных непустых ключей, встречающихся больше одного раза
+    return sum(1 for key, count in collections.Counter(keys).items() if count > 1 and key != '')
+
+
+@dataclass
+class RateEstimate:
+    rate: float
+    low: float
+    high: float
+    population: int
+
+    @property
+    def count(self):
+        return round(self.rate * self.population)
+
+    @property
+    def count_low(self):
+        return math.floor(self.low * self.population)
+
+    @property
+    def count_high(self):
+        return math.ceil(self.high * self.population)
+
+
+@dataclass
+class QuickLook:
+    rows_old: int
+    rows_new: int
+    blocks_sampled: int
+    blocks_total: int
+    rows_sampled: int
+    # Построчное сравнение (как в app.py)
+    changed: RateEstimate
+    added_positional: int
+    # [(колонка, изменений в выборке, доля среди просмотренных строк)], по убыванию
+    top_columns: list
+    # Сопоставление колонок по строкам выборки (дубли ключа - в полях ниже)
+    schema: SchemaDrift = None
+    # Сравнение по ключу (None, если ключ не задан или его нет в одном из файлов)
+    key_col: object = None
+    added_by_key: int = None
+    deleted_by_key: int = None
+    changed_by_key: RateEstimate = None
+    top_columns_by_key: list = None
+    duplicate_keys_old: int = None
+    duplicate_keys_new: int = None
+
+
+def sample_changes(old_bytes, new_bytes, sheet_old, sheet_new, key_col=None, ignored=(),
+                   block_size=500, sample_blocks=20, seed=0, header_old=None, header_new=None):
+    """Оценка числа изменений по случайной выборке блоков строк обоих листов.
+
+    header_old/header_new - заголовки из sheet_columns (иначе читаются здесь же).
+    """
+    old = _SheetScan(old_bytes, sheet_old, header_old)
+    new = _SheetScan(new_bytes, sheet_new, header_new)
+
+    old_index = {name: i for i, name in enumerate(old.header)}
+    new_index = {name: j for j, name in enumerate(new.header)}
+    # Ключ с тем же именем читается сразу; переименованный - после сопоставления колонок
+    old_key = old_index.get(key_col) if key_col is not None else None
+    new_key = new_index.get(key_col) if old_key is not None else None
+
+    # Блоки выбираются до чтения данных по размеру листа из <dimension>;
+    # если его нет, лист сначала проходится один раз, чтобы узнать число строк
+    estimates = []
+    for scan in (old, new):
+        rows = scan.read_dimension()
+        if rows is None:
+            scan.scan()
+            rows = scan.last_row
+        estimates.append(rows - 1)
+    rng = random.Random(seed)
+
+    def choose_blocks(total):
+        blocks = sorted(rng.sample(range(total), min(sample_blocks, total)))
+        return blocks, [r for b in blocks for r in range(b * block_size + 2, (b + 1) * block_size + 2)]
+
+    blocks_estimated = math.ceil(max(min(estimates), 0) / block_size)
+    blocks, wanted = choose_blocks(blocks_estimated)
+    old.scan(wanted, old_key)
+    new.scan(wanted, new_key)
+
+    n_common = min(old.n_rows, new.n_rows)
+    blocks_total = math.ceil(n_common / block_size)
+    if blocks_total > blocks_estimated:
+        # <dimension> занизил размер листа - выбираем блоки заново и дочитываем строки
+        blocks, wanted = choose_blocks(blocks_total)
+        old.scan(wanted, collect=False)
+        new.scan(wanted, collect=False)
+    else:
+        # В <dimension> могли попасть пустые строки в конце - блоки за пределами данных отбрасываем
+        blocks = [b for b in blocks if b < blocks_total]
+    old.resolve_shared()
+    new.resolve_shared()
+    sampled_positions = [range(b * block_size, min((b + 1) * block_size, n_common)) for b in blocks]
+
+    # Колонки сопоставляются так же, как в точном сравнении (analyze_schema), но по строкам выборки:
+    # удаленные и добавленные колонки не сравниваются, переименованные сравниваются со своей парой
+    positions = [pos for block in sampled_positions for pos in block]
+    schema = analyze_schema(old.sample_frame(positions), new.sample_frame(positions))
+    compare_cols = [(old_index[o], new_index[n], o) for o, n in schema.pairs if o not in ignored]
+    if old_key is not None and new_key is None and key_col in schema.mapping:
+        # Ключ переименован во втором файле - его колонка дочитывается отдельным проходом
+        new_key = new_index[schema.mapping[key_col]]
+        new.scan(key_col=new_key)
+        new.resolve_shared()
+    keyed = old_key is not None and new_key is not None
+
+    if keyed:
+        old_keys = old.keys(old_key)
+        new_keys = new.keys(new_key)
+        old_first = {}
+        for pos, key in enumerate(old_keys):
+            old_first.setdefault(key, pos)
+
+        # По ключу сопоставляются строки всего нового листа, а не только общей с
+        # построчным сравнением части: если новый лист длиннее, блоки выбираются заново
+        keyed_total = math.ceil(new.n_rows / block_size)
+        keyed_blocks = blocks
+        if keyed_total > blocks_total:
+            keyed_blocks, wanted = choose_blocks(keyed_total)
+            missing = {r for r in wanted if r <= new.last_row} - new.rows.keys()
+            if missing:
+                new.scan(missing, collect=False)
+                new.resolve_shared()
+        keyed_positions = [range(b * block_size, min((b + 1) * block_size, new.n_rows)) for b in keyed_blocks]
+
+        # Строки старого файла с теми же ключами, что у строк выборки, дочитываем вторым проходом
+        needed = {
+            old_first[new_keys[pos]] + 2
+            for positions in keyed_positions for pos in positions
+            if new_keys[pos] in old_first
+        }
+        missing = needed - old.rows.keys()
+        if missing:
+            old.scan(missing, collect=False)
+            old.resolve_shared()
+
+    def row_changes(old_row, new_row, cols):
+        return [name for i, j, name in cols if old_row.get(i, '') != new_row.get(j, '')]
+
+    def top(column_hits, rows):
+        return sorted(
+            ((name, hits, hits / rows if rows else 0.0) for name, hits in column_hits.items() if hits),
+            key=lambda item: -item[1],
+        )
+
+    column_hits = {name: 0 for _, _, name in compare_cols}
+    positional_hits, positional_totals = [], []
+    for positions in sampled_positions:
+        hits = 0
+        for pos in positions:
+            diff = row_changes(old.data_row(pos), new.data_row(pos), compare_cols)
+            hits += bool(diff)
+            for name in diff:
+                column_hits[name] += 1
+        positional_hits.append(hits)
+        positional_totals.append(len(positions))
+
+    rows_sampled = sum(positional_totals)
+    rate, low, high = _ratio_interval(positional_hits, positional_totals, blocks_total)
+    result = QuickLook(
+        rows_old=old.n_rows,
+        rows_new=new.n_rows,
+        blocks_sampled=len(blocks),
+        blocks_total=blocks_total,
+        rows_sampled=rows_sampled,
+        changed=RateEstimate(rate, low, high, n_common),
+        added_positional=max(new.n_rows - old.n_rows, 0),
+        top_columns=top(column_hits, rows_sampled),
+        schema=schema,
+    )
+
+    if keyed:
+        new_key_set = set(new_keys)
+
+        # Новые и удаленные ключи - точно (ключевая колонка прочитана целиком)
+        result.key_col = key_col
+        result.added_by_key = sum(1 for key in new_keys if key not in old_first)
+        result.deleted_by_key = sum(1 for key in old_keys if key not in new_key_set)
+        result.duplicate_keys_old = _duplicated(old_keys)
+        result.duplicate_keys_new = _duplicated(new_keys)
+
+        # Измененные по ключу - оценка: строки нового файла из блоков keyed_blocks
+        # сравниваются со строкой старого файла с тем же ключом
+        key_cols = [(i, j, name) for i, j, name in compare_cols if name != key_col]
+        key_column_hits = {name: 0 for _, _, name in key_cols}
+        keyed_hits, keyed_totals = [], []
+        for positions in keyed_positions:
+            hits = total = 0
+            for pos in positions:
+                old_pos = old_first.get(new_keys[pos])
+                if old_pos is None:
+                    continue
+                total += 1
+                diff = row_changes(old.data_row(old_pos), new.data_row(pos), key_cols)
+                hits += bool(diff)
+                for name in diff:
+                    key_column_hits[name] += 1
+            keyed_hits.append(hits)
+            keyed_totals.append(total)
+        matched = len(new_keys) - result.added_by_key
+        result.changed_by_key = RateEstimate(*_ratio_interval(keyed_hits, keyed_totals, keyed_total), matched)
+        result.top_columns_by_key = top(key_column_hits, sum(keyed_totals))
+
+    return result
+
+
+@st.cache_data(**_CACHE_ARGS)
+def quick_look(src_old, src_new, sheet_old, sheet_new, key_col=None, ignored=(), block_size=500, sample_blocks=20):
+    """Кэшированная быстрая оценка для загруженных файлов."""
+    return sample_changes(
+        src_old.data, src_new.data, sheet_old, sheet_new, key_col, tuple(ignored), block_size, sample_blocks,
+        header_old=sheet_columns(src_old, sheet_old), header_new=sheet_columns(src_new, sheet_new),
+    )
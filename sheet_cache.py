@@ -0,0 +1,332 @@
+import dataclasses
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Общий для всех сессий кэш разобранных листов и результатов сравнения.
+#
+# Ключ листа - (хэш содержимого файла, имя листа), поэтому одинаковые файлы,
+# загруженные разными пользователями, разбираются один раз и хранятся в одном
+# экземпляре. Результаты сравнения лежат в том же кэше под ключом, первый
+# элемент которого - кортеж хэшей сравниваемых файлов, и считаются в тот же
+# лимит памяти. Сессии отмечают, какие записи они используют (счетчик ссылок).
+# При превышении лимита памяти холодные записи (сначала те, на которые никто не
+# ссылается) выгружаются на диск: у листов числовые колонки - в .npy, которые
+# затем открываются через memory-map, остальные - в pickle по колонкам;
+# результаты сравнения - в pickle целиком. Выгруженные записи без ссылок
+# удаляются с диска, когда превышен лимит диска.
+#
+# Выгрузка лишь отпускает ссылку кэша: пока объект держит вызывающий код, его
+# память по-прежнему учитывается в лимите, а повторный запрос возвращает тот же
+# объект, а не вторую копию с диска.
+
+MB = 1024 * 1024
+
+# Сессия, которая давно не обращалась к кэшу, считается закрытой
+SESSION_TTL = 60 * 60
+
+
+def _is_mapped(values):
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return True
+        values = getattr(values, 'base', None)
+    return False
+
+
+def _frame_bytes(df):
+    # Колонки, открытые через memory-map, лежат на диске и не занимают память процесса
+    return int(sum(
+        col.memory_usage(index=False, deep=True)
+        for _, col in df.items()
+        if not _is_mapped(col.array.to_numpy() if hasattr(col.array, 'to_numpy') else None)
+    ))
+
+
+def object_bytes(obj, exclude=frozenset()):
+    """Память DataFrame/массивов numpy объекта, в том числе внутри dataclass, списков и словарей.
+
+    exclude - id объектов, которые уже учтены в других записях кэша.
+    """
+    if id(obj) in exclude:
+        return 0
+    if isinstance(obj, pd.DataFrame):
+        return _frame_bytes(obj)
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=False, deep=True))
+    if isinstance(obj, np.ndarray):
+        if _is_mapped(obj):
+            return 0
+        if obj.dtype == object:
+            return int(pd.Series(obj.ravel()).memory_usage(index=False, deep=True))
+        return int(obj.nbytes)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return sum(object_bytes(getattr(obj, f.name), exclude) for f in dataclasses.fields(obj))
+    if isinstance(obj, (list, tuple)):
+        return sum(object_bytes(item, exclude) for item in obj)
+    if isinstance(obj, dict):
+        return sum(object_bytes(item, exclude) for item in obj.values())
+    return 0
+
+
+def _write_spill(obj, path):
+    os.makedirs(path)
+    if not isinstance(obj, pd.DataFrame):
+        # Результаты сравнения выгружаются целиком
+        with open(os.path.join(path, 'object.pkl'), 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return os.path.getsize(os.path.join(path, 'object.pkl'))
+    df = obj
+    layout = []
+    for i, (name, col) in enumerate(df.items()):
+        if isinstance(col.dtype, np.dtype) and col.dtype.kind in 'biufcmM':
+            np.save(os.path.join(path, f'{i}.npy'), col.to_numpy(), allow_pickle=False)
+            layout.append((name, 'npy'))
+        else:
+            with open(os.path.join(path, f'{i}.pkl'), 'wb') as f:
+                pickle.dump(col.array, f, protocol=pickle.HIGHEST_PROTOCOL)
+            layout.append((name, 'pkl'))
+    with open(os.path.join(path, 'meta.pkl'), 'wb') as f:
+        pickle.dump((layout, df.index), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def _read_spill(path):
+    if os.path.exists(os.path.join(path, 'object.pkl')):
+        with open(os.path.join(path, 'object.pkl'), 'rb') as f:
+            return pickle.load(f)
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+        layout, index = pickle.load(f)
+    columns = {}
+    for i, (_, kind) in enumerate(layout):
+        if kind == 'npy':
+            columns[i] = np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r')
+        else:
+            with open(os.path.join(path, f'{i}.pkl'), 'rb') as f:
+                columns[i] = pickle.load(f)
+    # copy=False: колонки не объединяются в общий блок, memory-map сохраняется
+    df = pd.DataFrame(columns, index=index, copy=False)
+    df.columns = pd.Index([name for name, _ in layout])
+    return df
+
+
+def _digests(key):
+    # Первый элемент ключа - хэш файла (лист) или кортеж хэшей (результат сравнения)
+    return key[0] if isinstance(key[0], tuple) else (key[0],)
+
+
+class _Entry:
+    def __init__(self, frame, nbytes):
+        self.frame = frame
+        self.nbytes = nbytes
+        # Объект, выгруженный на диск, но еще используемый вызывающим кодом
+        self.ref = None
+        self.path = None
+        self.disk_bytes = 0
+        # Защищает frame/ref/path при выгрузке и обратной загрузке
+        self.lock = threading.Lock()
+
+    def held(self):
+        return self.frame is None and self.ref is not None and self.ref() is not None
+
+    def resident(self):
+        return self.frame is not None or self.held()
+
+
+class SheetCache:
+    """Потокобезопасный кэш DataFrame (и результатов сравнения) с подсчетом ссылок и выгрузкой на диск."""
+
+    def __init__(self, memory_limit, disk_limit, spill_root):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        os.makedirs(spill_root, exist_ok=True)
+        # Отдельный каталог процесса: чужие файлы в spill_root не трогаем
+        self.spill_dir = tempfile.mkdtemp(prefix='sheets-', dir=spill_root)
+        # Каталог удаляется вместе с кэшем (st.cache_resource.clear()) или при выходе из процесса
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+        # Порядок блокировок: entry.lock -> self._lock (не наоборот)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # от давно использованных к недавним
+        self._loading = {}
+        self._sessions = {}  # session_id -> {ключ: время последнего обращения}
+        self._stats = dict(hits=0, misses=0, disk_loads=0, spills=0, evictions=0)
+
+    # --- ДОСТУП ---
+
+    def get(self, key, loader, session_id=None):
+        """Объект по ключу; при промахе loader() вызывается один раз, даже при параллельных запросах."""
+        with self._lock:
+            if session_id is not None:
+                self._sessions.setdefault(session_id, {})[key] = time.time()
+            entry = self._entries.get(key)
+            if entry is None:
+                key_lock = self._loading.setdefault(key, threading.Lock())
+            else:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+
+        if entry is None:
+            # Разбор - вне общей блокировки: остальные листы в это время доступны
+            with key_lock:
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        self._stats['hits'] += 1
+                if entry is None:
+                    frame = loader()
+                    entry = _Entry(frame, object_bytes(frame, self._resident_ids()))
+                    with self._lock:
+                        self._entries[key] = entry
+                        self._loading.pop(key, None)
+                        self._stats['misses'] += 1
+
+        frame = self._materialize(entry)
+        self._enforce_limits()
+        return frame
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def retain(self, session_id, digests):
+        """Снимает ссылки сессии на записи файлов, которых больше нет среди ее загрузок."""
+        with self._lock:
+            keys = self._sessions.get(session_id, {})
+            for key in [key for key in keys if not set(_digests(key)) <= set(digests)]:
+                del keys[key]
+        self._enforce_limits()
+
+    def _resident_ids(self):
+        # Объекты, уже учтенные в кэше: результат сравнения может ссылаться на закэшированный лист
+        with self._lock:
+            entries = list(self._entries.values())
+        ids = set()
+        for entry in entries:
+            frame = entry.frame if entry.frame is not None else (entry.ref() if entry.ref is not None else None)
+            if frame is not None:
+                ids.add(id(frame))
+        return ids
+
+    def _refcounts(self):
+        now = time.time()
+        counts = {}
+        for session_id, keys in list(self._sessions.items()):
+            for key, seen in list(keys.items()):
+                if now - seen > SESSION_TTL:
+                    del keys[key]
+                else:
+                    counts[key] = counts.get(key, 0) + 1
+            if not keys:
+                del self._sessions[session_id]
+        return counts
+
+    # --- ВЫГРУЗКА НА ДИСК ---
+
+    def _materialize(self, entry):
+        with entry.lock:
+            if entry.frame is not None:
+                return entry.frame
+            frame = entry.ref() if entry.ref is not None else None
+            if frame is not None:
+                # Объект еще жив у вызывающего кода - возвращаем его, а не вторую копию с диска
+                entry.frame = frame
+                entry.ref = None
+                return frame
+            exclude = self._resident_ids()
+            entry.frame = frame = _read_spill(entry.path)
+            entry.nbytes = object_bytes(frame, exclude)
+        with self._lock:
+            self._stats['disk_loads'] += 1
+        return frame
+
+    def _spill(self, entry):
+        with entry.lock:
+            if entry.frame is None:
+                return False
+            written = entry.path is None
+            if written:
+                entry.path = os.path.join(self.spill_dir, uuid.uuid4().hex)
+                entry.disk_bytes = _write_spill(entry.frame, entry.path)
+            # Ссылки на frame у вызывающих остаются валидными, кэш лишь отпускает свою;
+            # пока они есть, память записи учитывается (см. _Entry.held)
+            try:
+                entry.ref = weakref.ref(entry.frame)
+            except TypeError:
+                entry.ref = None
+            entry.frame = None
+        return written
+
+    def _enforce_limits(self):
+        # Жертвы выбираются под общей блокировкой, а запись на диск идет без нее
+        with self._lock:
+            counts = self._refcounts()
+            resident = sum(e.nbytes for e in self._entries.values() if e.resident())
+            to_spill = []
+            if resident > self.memory_limit:
+                # Сначала записи без ссылок, затем остальные - от давно использованных
+                order = sorted(self._entries.items(), key=lambda kv: counts.get(kv[0], 0) > 0)
+                for key, entry in order:
+                    if resident <= self.memory_limit:
+                        break
+                    if entry.frame is not None:
+                        resident -= entry.nbytes
+                        to_spill.append(entry)
+
+        spilled = sum(self._spill(entry) for entry in to_spill)
+
+        to_remove = []
+        with self._lock:
+            self._stats['spills'] += spilled
+            on_disk = sum(e.disk_bytes for e in self._entries.values())
+            for key, entry in list(self._entries.items()):
+                if on_disk <= self.disk_limit:
+                    break
+                if entry.frame is None and not entry.held() and not counts.get(key):
+                    on_disk -= entry.disk_bytes
+                    del self._entries[key]
+                    to_remove.append(entry.path)
+                    self._stats['evictions'] += 1
+
+        for path in to_remove:
+            shutil.rmtree(path, ignore_errors=True)
+
+    # --- МЕТРИКИ ---
+
+    def metrics(self):
+        with self._lock:
+            counts = self._refcounts()
+            in_memory = [e for e in self._entries.values() if e.resident()]
+            held = [e for e in in_memory if e.held()]
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(
+                self._stats,
+                hit_rate=round(self._stats['hits'] / lookups, 3) if lookups else None,
+                sessions=len(self._sessions),
+                entries=len(self._entries),
+                entries_in_memory=len(in_memory),
+                entries_referenced=sum(1 for key in self._entries if counts.get(key)),
+                # В том числе выгруженные записи, которые еще держит вызывающий код
+                entries_held=len(held),
+                memory_mb=round(sum(e.nbytes for e in in_memory) / MB, 1),
+                memory_held_mb=round(sum(e.nbytes for e in held) / MB, 1),
+                memory_limit_mb=round(self.memory_limit / MB, 1),
+                disk_mb=round(sum(e.disk_bytes for e in self._entries.values()) / MB, 1),
+            )
+
+
+def from_environment():
+    """Кэш с лимитами из переменных окружения (для Docker/сервера)."""
+    return SheetCache(
+        memory_limit=int(float(os.environ.get('EXCEL_APP_CACHE_MB', 2048)) * MB),
+        disk_limit=int(float(os.environ.get('EXCEL_APP_DISK_CACHE_MB', 20480)) * MB),
+        spill_root=os.environ.get('EXCEL_APP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'excel_app_cache')),
+    )
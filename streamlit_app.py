@@ -1,6 +1,8 @@
 import streamlit as st
 import pandas as pd
 
+import compare_engine
+
 # Настройка страницы
 st.set_page_config(page_title="Сравнение Excel с игнорированием столбцов", layout="wide")
 
@@ -12,149 +14,203 @@ st.markdown("""
 * 🟡 **Изменено**: Строка есть в обоих, но значения (кроме игнорируемых) отличаются.
 """)
 
+
+# --- ФРАГМЕНТЫ ---
+# Каждый фрагмент перезапускается независимо: изменение настроек вкладки
+# не перечитывает файлы и не трогает блок результатов.
+
+def _refresh_results():
+    # Результат уже показан - пересобираем его из кэша без повторного сравнения
+    st.session_state['refresh_results'] = 'compared_run' in st.session_state
+
+
+@st.fragment
+def sheet_settings(src1, sheet):
+    # Заголовки берутся из кэша (читается только первая строка листа)
+    columns = compare_engine.sheet_columns(src1, sheet)
+
+    # multiselect позволяет выбрать несколько колонок
+    st.multiselect(
+        f"Игнорировать столбцы во вкладке '{sheet}':",
+        columns,
+        key=f"ignore_{sheet}", # уникальный ключ для виджета
+        help="Эти колонки не будут учитываться при поиске различий",
+        on_change=_refresh_results
+    )
+    if st.session_state.pop('refresh_results', False):
+        st.rerun()
+
+
+def show_quick_look(q, by_key):
+    st.write(
+        f"Просмотрено строк: {q.rows_sampled} ({q.blocks_sampled} из {q.blocks_total} блоков). "
+        f"Строк в файлах: {q.rows_old} → {q.rows_new}."
+    )
+    # Колонки сопоставлены по строкам выборки (как в полном сравнении)
+    for message in q.schema.messages():
+        st.warning(message)
+    if q.key_col is not None:
+        st.write(
+            f"🔑 По ключу '{q.key_col}' (точно): новых **{q.added_by_key}**, удаленных **{q.deleted_by_key}**."
+        )
+    if by_key:
+        changed, top_columns = q.changed_by_key, q.top_columns_by_key
+    else:
+        changed, top_columns = q.changed, q.top_columns
+        st.write(f"🟢 Добавлено (строк больше во втором файле): **{q.added_positional}**")
+    st.write(
+        f"🟡 Изменено: **≈ {changed.count}** ({changed.rate:.2%}), "
+        f"95% интервал: {changed.count_low} – {changed.count_high}"
+    )
+    if q.duplicate_keys_old or q.duplicate_keys_new:
+        st.warning(f"Дубли ключа: в старом файле {q.duplicate_keys_old}, в новом {q.duplicate_keys_new}.")
+    if top_columns:
+        st.dataframe(
+            pd.DataFrame(top_columns, columns=['Колонка', 'Изменений в выборке', 'Доля строк']),
+            use_container_width=True
+        )
+
+
+@st.fragment
+def quick_look_view(src1, src2, selected_sheets):
+    with st.expander("⚡ Быстрая оценка по выборке (до полного сравнения)"):
+        st.caption(
+            "Читается случайная выборка блоков строк обоих файлов, без полного разбора. "
+            "Помогает понять масштаб изменений и подобрать игнорируемые колонки."
+        )
+        sheet = st.selectbox("Вкладка для оценки:", selected_sheets, key="ql_sheet")
+        columns = compare_engine.sheet_columns(src1, sheet)
+        key_col = st.selectbox(
+            "🔑 Колонка-ключ для подсчета новых/удаленных (необязательно):",
+            [None] + columns,
+            format_func=lambda c: "—" if c is None else str(c),
+            key="ql_key"
+        )
+        col1, col2 = st.columns(2)
+        block_size = col1.number_input("Строк в блоке:", min_value=50, max_value=10000, value=500, step=50, key="ql_block")
+        sample_blocks = col2.number_input("Блоков в выборке:", min_value=1, max_value=1000, value=20, key="ql_blocks")
+
+        if st.button("⚡ Оценить", key="ql_run"):
+            try:
+                with st.spinner("Оцениваем по выборке..."):
+                    q = compare_engine.quick_look(
+                        src1, src2, sheet, sheet,
+                        key_col=key_col,
+                        ignored=tuple(st.session_state.get(f"ignore_{sheet}", [])),
+                        block_size=int(block_size),
+                        sample_blocks=int(sample_blocks)
+                    )
+                show_quick_look(q, by_key=False)
+            except Exception as e:
+                st.error(f"Не удалось выполнить быструю оценку: {e}")
+
+
+@st.fragment
+def results_view(src1, src2, selected_sheets):
+    # Параметры, от которых зависит само сравнение (игнорируемые колонки сюда не входят)
+    run = (src1.digest, src2.digest, tuple(selected_sheets))
+
+    # --- 3. КНОПКА ЗАПУСКА ---
+    if st.button("🔍 Найти различия (с учетом игнорируемых колонок)"):
+        if not selected_sheets:
+            st.warning("Выберите вкладки.")
+            return
+        st.session_state['compared_run'] = run
+    if st.session_state.get('compared_run') != run:
+        return
+
+    try:
+        all_results = {}
+        progress_bar = st.progress(0)
+        progress_text = st.empty()
+
+        # Быстрый путь: листы с одинаковыми сырыми XML-частями не читаем и не сравниваем
+        skipped_sheets = compare_engine.identical_sheets(src1, src2, selected_sheets)
+
+        # --- 4. ЛОГИКА СРАВНЕНИЯ ---
+        for i, sheet in enumerate(selected_sheets):
+            if sheet in skipped_sheets:
+                progress_text.text(f"Вкладка '{sheet}': данные совпадают побайтно, сравнение пропущено.")
+                all_results[sheet] = pd.DataFrame()
+                progress_bar.progress((i + 1) / len(selected_sheets))
+                continue
+
+            progress_text.text(f"Сравниваем вкладку '{sheet}'...")
+            # Общий движок: разбор и сравнение кэшируются по содержимому файлов,
+            # игнорируемые колонки применяются к готовой карте различий
+            comparison = compare_engine.compare_sheets(src1, src2, sheet, sheet)
+            # Новые/удаленные/переименованные колонки и смена типов (колонки выровнены движком)
+            for message in comparison.schema.messages():
+                st.warning(f"Вкладка '{sheet}': {message}")
+            all_results[sheet] = comparison.positional(st.session_state.get(f"ignore_{sheet}", []))
+
+            progress_bar.progress((i + 1) / len(selected_sheets))
+
+        # --- 5. ВЫВОД РЕЗУЛЬТАТА ---
+        st.subheader("Результат")
+
+        for sheet, df_res in all_results.items():
+            if sheet in skipped_sheets:
+                st.success(f"⚡ Вкладка **'{sheet}'**: Идентична (сырые данные листа совпадают, чтение и сравнение пропущены).")
+            elif df_res.empty:
+                st.info(f"Вкладка **'{sheet}'**: Различий (с учетом исключений) не найдено.")
+            else:
+                with st.expander(f"Вкладка: {sheet} (Записей: {len(df_res)})"):
+                    st.dataframe(df_res, use_container_width=True)
+
+                    csv = df_res.to_csv(index=False).encode('utf-8-sig')
+                    st.download_button(
+                        label=f"📥 Скачать '{sheet}' (CSV)",
+                        data=csv,
+                        file_name=f'result_{sheet}.csv',
+                        mime='text/csv',
+                        key=f'dl_{sheet}'
+                    )
+
+    except Exception as e:
+        st.error(f"Ошибка обработки: {e}")
+
+
 # --- 1. ПРИНИМАЕМ ДВА ФАЙЛА ---
 st.sidebar.header("Загрузка файлов")
 file1 = st.sidebar.file_uploader("1. Файл за День 1 (Старый)", type=['xlsx'])
 file2 = st.sidebar.file_uploader("2. Файл за День 2 (Новый)", type=['xlsx'])
 
+# Состояние общего (для всех сессий) кэша разобранных листов
+with st.sidebar.expander("📈 Общий кэш листов"):
+    st.json(compare_engine.cache_metrics())
+
 if file1 and file2:
     try:
-        xls1 = pd.ExcelFile(file1)
-        xls2 = pd.ExcelFile(file2)
-        
-        sheets1 = xls1.sheet_names
-        sheets2 = xls2.sheet_names
-        
+        # Содержимое хэшируется один раз на загрузку, список листов берется из кэша;
+        # листы прежних загрузок этой сессии освобождаются в общем кэше
+        src1, src2 = compare_engine.source_files(file1, file2)
+
+        sheets1 = compare_engine.sheet_names(src1)
+        sheets2 = compare_engine.sheet_names(src2)
+
         common_sheets = list(set(sheets1) & set(sheets2))
         common_sheets.sort()
-        
+
         if not common_sheets:
             st.error("Нет общих вкладок для сравнения!")
         else:
             # --- 2. ВЫБОР ВКЛАДОК ---
             st.subheader("Шаг 1: Выберите вкладки")
             selected_sheets = st.multiselect("Выберите вкладки:", common_sheets, default=common_sheets)
-            
+
             # --- НОВАЯ ФУНКЦИЯ: ВЫБОР СТОЛБЦОВ ДЛЯ ИГНОРИРОВАНИЯ ---
-            ignored_cols_map = {} # Словарь: {имя_вкладки: [список_игнорируемых_колонок]}
-            
             if selected_sheets:
                 st.subheader("Шаг 2: Выберите столбцы для игнорирования")
                 st.info("Если в списке ничего не выбрано, сравниваются все столбцы.")
-                
+
                 # Для каждой выбранной вкладки создаем свой выборщик
                 for sheet in selected_sheets:
-                    # Читаем только заголовки, чтобы получить список колонок
-                    # nrows=1 ускоряет чтение, так как нам нужны только названия колонок
-                    df_preview = pd.read_excel(xls1, sheet_name=sheet, nrows=1)
-                    columns = df_preview.columns.tolist()
-                    
-                    # multiselect позволяет выбрать несколько колонок
-                    ignored = st.multiselect(
-                        f"Игнорировать столбцы во вкладке '{sheet}':", 
-                        columns, 
-                        key=f"ignore_{sheet}", # уникальный ключ для виджета
-                        help="Эти колонки не будут учитываться при поиске различий"
-                    )
-                    ignored_cols_map[sheet] = ignored
-            
-            # --- 3. КНОПКА ЗАПУСКА ---
-            if st.button("🔍 Найти различия (с учетом игнорируемых колонок)"):
-                if not selected_sheets:
-                    st.warning("Выберите вкладки.")
-                else:
-                    all_results = {}
-                    progress_bar = st.progress(0)
-                    
-                    # --- 4. ЛОГИКА СРАВНЕНИЯ ---
-                    for i, sheet in enumerate(selected_sheets):
-                        df1 = pd.read_excel(xls1, sheet_name=sheet).fillna('')
-                        df2 = pd.read_excel(xls2, sheet_name=sheet).fillna('')
-                        
-                        df1.reset_index(drop=True, inplace=True)
-                        df2.reset_index(drop=True, inplace=True)
-                        
-                        # Получаем список колонок, которые нужно игнорировать для этой вкладки
-                        current_ignored = ignored_cols_map.get(sheet, [])
-                        
-                        # Формируем список колонок, по которым СРАВНИВАЕМ
-                        # (все колонки минус игнорируемые)
-                        cols_to_compare = [c for c in df1.columns if c not in current_ignored]
-                        
-                        max_rows = max(len(df1), len(df2))
-                        results = []
-                        
-                        for row_idx in range(max_rows):
-                            row_data = {}
-                            status = ""
-                            
-                            # Логика НОВОЙ строки
-                            if row_idx >= len(df1):
-                                status = "🟢 Добавлено"
-                                for col in df2.columns:
-                                    row_data[f"{col}_Day2"] = df2.at[row_idx, col]
-                                for col in df1.columns:
-                                    row_data[f"{col}_Day1"] = ""
-                            
-                            # Логика УДАЛЕННОЙ строки (пропускаем)
-                            elif row_idx >= len(df2):
-                                continue 
-                            
-                            # Логика ИЗМЕНЕНИЯ
-                            else:
-                                is_different = False
-                                
-                                # Важно: В результат записываем ВСЕ колонки, но сравниваем только cols_to_compare
-                                for col in df1.columns:
-                                    val1 = df1.at[row_idx, col]
-                                    val2 = df2.at[row_idx, col] if col in df2.columns else ""
-                                    
-                                    row_data[f"{col}_Day1"] = val1
-                                    row_data[f"{col}_Day2"] = val2
-                                    
-                                    # ПРОВЕРКА: Если колонка не в списке игнорируемых -> сравниваем
-                                    if col in cols_to_compare:
-                                        if str(val1) != str(val2):
-                                            is_different = True
-                                
-                                if is_different:
-                                    status = "🟡 Изменено"
-                                else:
-                                    status = "⚪ Без изменений"
-                            
-                            # Фильтрация результата (только Новые и Измененные)
-                            if status in ["🟢 Добавлено", "🟡 Изменено"]:
-                                row_data['Status'] = status
-                                results.append(row_data)
-
-                        if results:
-                            df_result = pd.DataFrame(results)
-                            cols = ['Status'] + [c for c in df_result.columns if c != 'Status']
-                            df_result = df_result[cols]
-                            all_results[sheet] = df_result
-                        else:
-                            all_results[sheet] = pd.DataFrame()
-                            
-                        progress_bar.progress((i + 1) / len(selected_sheets))
-                    
-                    # --- 5. ВЫВОД РЕЗУЛЬТАТА ---
-                    st.subheader("Результат")
-                    
-                    for sheet, df_res in all_results.items():
-                        if df_res.empty:
-                            st.info(f"Вкладка **'{sheet}'**: Различий (с учетом исключений) не найдено.")
-                        else:
-                            with st.expander(f"Вкладка: {sheet} (Записей: {len(df_res)})"):
-                                st.dataframe(df_res, use_container_width=True)
-                                
-                                csv = df_res.to_csv(index=False).encode('utf-8-sig')
-                                st.download_button(
-                                    label=f"📥 Скачать '{sheet}' (CSV)",
-                                    data=csv,
-                                    file_name=f'result_{sheet}.csv',
-                                    mime='text/csv',
-                                    key=f'dl_{sheet}'
-                                )
+                    sheet_settings(src1, sheet)
+
+                quick_look_view(src1, src2, selected_sheets)
+
+            results_view(src1, src2, selected_sheets)
 
     except Exception as e:
         st.error(f"Ошибка обработки: {e}")
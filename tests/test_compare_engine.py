@@ -0,0 +1,234 @@
+import io
+import re
+import zipfile
+
+import pandas as pd
+import pytest
+
+import compare_engine
+
+_INLINE_CELL_RE = re.compile(rb'<c ([^>]*?)t="inlineStr"([^>]*)><is><t[^>]*>(.*?)</t></is></c>', re.S)
+
+
+def make_workbook(sheets, shared=True):
+    """xlsx из {имя_листа: DataFrame}; с shared=True строки, как в Excel, вынесены в sharedStrings."""
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+    return shared_strings(buf.getvalue()) if shared else buf.getvalue()
+
+
+def shared_strings(data):
+    # openpyxl пишет строки inline; Excel нумерует общие строки по порядку листов
+    strings = {}
+
+    def to_shared(m):
+        index = strings.setdefault(m.group(3), len(strings))
+        return b'<c %st="s"%s><v>%d</v></c>' % (m.group(1), m.group(2), index)
+
+    src = zipfile.ZipFile(io.BytesIO(data))
+    parts = {name: src.read(name) for name in src.namelist()}
+    for name in sorted(parts, key=lambda n: [int(d) for d in re.findall(r'\d+', n)]):
+        if name.startswith('xl/worksheets/'):
+            parts[name] = _INLINE_CELL_RE.sub(to_shared, parts[name])
+    parts['xl/sharedStrings.xml'] = (
+        b'<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        + b''.join(b'<si><t>%s</t></si>' % text for text in strings)
+        + b'</sst>'
+    )
+    parts['xl/_rels/workbook.xml.rels'] = parts['xl/_rels/workbook.xml.rels'].replace(
+        b'</Relationships>',
+        b'<Relationship Id="rIdShared" Target="sharedStrings.xml" Type="http://schemas.openxmlformats.org'
+        b'/officeDocument/2006/relationships/sharedStrings"/></Relationships>',
+    )
+    parts['[Content_Types].xml'] = parts['[Content_Types].xml'].replace(
+        b'</Types>',
+        b'<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument'
+        b'.spreadsheetml.sharedStrings+xml"/></Types>',
+    )
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as dst:
+        for name, content in parts.items():
+            dst.writestr(name, content)
+    return out.getvalue()
+
+
+def test_shared_strings_workbook_reads_back():
+    df = pd.DataFrame({'name': ['foo', 'bar', 'foo'], 'n': [1, 2, 3]})
+    data = make_workbook({'S': df})
+    assert b'inlineStr' not in zipfile.ZipFile(io.BytesIO(data)).read('xl/worksheets/sheet1.xml')
+    pd.testing.assert_frame_equal(pd.read_excel(io.BytesIO(data)), df)
+
+
+# --- БЫСТРАЯ ПРОВЕРКА ИДЕНТИЧНЫХ ЛИСТОВ ---
+
+def test_digest_ignores_shared_string_numbering():
+    unchanged = pd.DataFrame({'name': ['foo', 'bar', 'baz'], 'n': [1, 2, 3]})
+    old = make_workbook({'S': pd.DataFrame({'a': ['p', 'q']}), 'T': unchanged})
+    # Новые строки на листе S сдвигают индексы общих строк листа T
+    new = make_workbook({'S': pd.DataFrame({'a': ['p', 'new 1', 'new 2', 'q']}), 'T': unchanged})
+
+    digests_old = compare_engine.sheet_digests(old)
+    digests_new = compare_engine.sheet_digests(new)
+    assert digests_old['T'] == digests_new['T']
+    assert digests_old['S'] != digests_new['S']
+
+
+def test_digest_detects_changed_and_swapped_strings():
+    def digest(names):
+        return compare_engine.sheet_digests(make_workbook({'T': pd.DataFrame({'name': names})}))['T']
+
+    base = digest(['foo', 'bar'])
+    assert digest(['foo', 'bar']) == base
+    assert digest(['foo', 'baz']) != base
+    assert digest(['bar', 'foo']) != base
+
+
+# --- ЕДИНЫЙ ДВИЖОК СРАВНЕНИЯ ---
+
+def test_keyed_diff_ignores_time_in_dates():
+    old = pd.DataFrame({
+        'ID': [1, 2],
+        'date': pd.to_datetime(['2024-01-01 10:00', '2024-01-02 10:00']),
+        'v': [1, 2],
+    })
+    new = old.copy()
+    new.loc[0, 'date'] = pd.Timestamp('2024-01-01 18:30')
+    new.loc[1, 'v'] = 3
+
+    result = compare_engine.compare_frames(old, new, key_col='ID', sort_col='ID', ignore_time_in_dates=True)
+    assert len(result.positional([])) == 1
+    assert len(result.changed([])) == 1
+
+    result = compare_engine.compare_frames(old, new, key_col='ID', sort_col='ID')
+    assert len(result.changed([])) == 2
+
+
+# --- БЫСТРАЯ ОЦЕНКА ПО ВЫБОРКЕ ---
+
+def make_pair(rows=600):
+    """Пара листов с общими и inline-строками, датами, пустыми строками и колонками int/float."""
+    old = pd.DataFrame({
+        'ID': range(rows),
+        'name': [f'name {i}' for i in range(rows)],
+        'amount': [i * 1.5 for i in range(rows)],
+        'count': [i % 7 for i in range(rows)],
+        'date': pd.date_range('2024-01-01', periods=rows, freq='h'),
+    })
+    # Пустая строка посередине: read_excel ее сохраняет, позиции остальных строк не сдвигаются
+    old.loc[120] = None
+    new = old.copy()
+    new.loc[10::37, 'name'] += ' x'
+    new.loc[3::101, 'amount'] += 1
+    # Пропуск делает целую колонку float64: 1 -> "1.0" во всех строках нового файла
+    new.loc[250, 'count'] = None
+    new.loc[7::53, 'date'] += pd.Timedelta(days=1)
+    new = pd.concat([new.drop(index=range(400, 420)), pd.DataFrame({'ID': range(1000, 1030)})], ignore_index=True)
+    new.loc[[500, 501], 'ID'] = 5  # ключ 5 трижды: это один ключ с дублями
+    return old, new
+
+
+def exact_counts(old_bytes, new_bytes, key_col=None):
+    df_old = pd.read_excel(io.BytesIO(old_bytes), sheet_name='S')
+    df_new = pd.read_excel(io.BytesIO(new_bytes), sheet_name='S')
+    result = compare_engine.compare_frames(df_old, df_new, key_col=key_col)
+    positional = result.positional()
+    changed = int((positional['Status'] == compare_engine.STATUS_CHANGED).sum()) if len(positional) else 0
+    return result, changed
+
+
+@pytest.mark.parametrize('shared', [True, False], ids=['shared_strings', 'inline_strings'])
+@pytest.mark.parametrize('key_col', [None, 'ID'])
+def test_full_sample_matches_compare_frames(shared, key_col):
+    old, new = make_pair()
+    old_bytes = make_workbook({'S': old}, shared=shared)
+    new_bytes = make_workbook({'S': new}, shared=shared)
+    exact, changed = exact_counts(old_bytes, new_bytes, key_col)
+
+    q = compare_engine.sample_changes(old_bytes, new_bytes, 'S', 'S', key_col=key_col,
+                                      block_size=50, sample_blocks=10 ** 6)
+    assert changed > 0
+    assert (q.rows_old, q.rows_new) == (exact.rows_old, exact.rows_new)
+    assert (q.changed.count, q.changed.low, q.changed.high) == (changed, q.changed.rate, q.changed.rate)
+    if key_col is None:
+        return
+    assert q.changed_by_key.population > 0
+    assert q.changed_by_key.count == len(exact.changed())
+    assert q.changed_by_key.low == q.changed_by_key.high
+    assert (q.added_by_key, q.deleted_by_key) == (len(exact.added), len(exact.deleted))
+    assert (q.duplicate_keys_old, q.duplicate_keys_new) == (
+        exact.schema.duplicate_keys_old, exact.schema.duplicate_keys_new)
+
+
+def test_full_sample_matches_int_float_columns():
+    old = pd.DataFrame({'ID': range(300), 'int': range(300), 'frac': [i / 2 for i in range(300)]})
+    new = old.copy()
+    new.loc[5::40, 'int'] += 1
+    # Пропуск в новом файле: колонка становится float64, и 1 печатается как "1.0"
+    new.loc[299, 'int'] = None
+    new.loc[0::30, 'frac'] = 0.25
+    old_bytes, new_bytes = make_workbook({'S': old}), make_workbook({'S': new})
+    exact, changed = exact_counts(old_bytes, new_bytes, 'ID')
+
+    q = compare_engine.sample_changes(old_bytes, new_bytes, 'S', 'S', key_col='ID',
+                                      block_size=50, sample_blocks=10 ** 6)
+    assert changed == 300
+    assert q.changed.count == changed
+    assert q.changed_by_key.count == len(exact.changed())
+    assert dict((name, hits) for name, hits, _ in q.top_columns) == {'int': 300, 'frac': 10}
+
+
+def test_full_sample_matches_with_ignored_columns():
+    old, new = make_pair()
+    old_bytes, new_bytes = make_workbook({'S': old}), make_workbook({'S': new})
+    df_old = pd.read_excel(io.BytesIO(old_bytes))
+    df_new = pd.read_excel(io.BytesIO(new_bytes))
+    exact = compare_engine.compare_frames(df_old, df_new, key_col='ID')
+
+    q = compare_engine.sample_changes(old_bytes, new_bytes, 'S', 'S', key_col='ID', ignored=('count', 'date'),
+                                      block_size=50, sample_blocks=10 ** 6)
+    assert q.changed_by_key.count == len(exact.changed(['count', 'date']))
+    assert dict((name, hits) for name, hits, _ in q.top_columns_by_key) == {
+        name: int(exact.matched_bitmap[:, j].sum())
+        for j, name in enumerate(exact.matched_columns)
+        if name not in ('count', 'date') and exact.matched_bitmap[:, j].any()
+    }
+
+
+def test_keyed_sample_covers_longer_new_sheet():
+    old = pd.DataFrame({'ID': range(1000), 'v': ['a'] * 1000})
+    # Совпадающие по ключу строки есть и за пределами общей с построчным сравнением части
+    new = pd.concat([
+        old.iloc[:500],
+        pd.DataFrame({'ID': range(10_000, 15_000), 'v': ['a'] * 5000}),
+        old.iloc[500:].assign(v='b'),
+    ], ignore_index=True)
+    old_bytes, new_bytes = make_workbook({'S': old}), make_workbook({'S': new})
+
+    q = compare_engine.sample_changes(old_bytes, new_bytes, 'S', 'S', key_col='ID',
+                                      block_size=100, sample_blocks=10 ** 6)
+    assert q.changed_by_key.count == 500
+    assert q.changed_by_key.low == q.changed_by_key.high
+
+    q = compare_engine.sample_changes(old_bytes, new_bytes, 'S', 'S', key_col='ID', block_size=100, sample_blocks=5)
+    assert q.changed_by_key.low < q.changed_by_key.high
+
+
+def test_partial_sample_without_hits_has_nonzero_interval():
+    old = pd.DataFrame({'ID': range(20_000), 'v': [1] * 20_000})
+    new = old.copy()
+    new.loc[[3, 5000, 9000, 14_000, 19_999], 'v'] = 2
+    q = compare_engine.sample_changes(make_workbook({'S': old}), make_workbook({'S': new}), 'S', 'S',
+                                      block_size=500, sample_blocks=5, seed=0)
+    assert q.changed.count == 0
+    assert q.changed.count_low == 0
+    # Ноль изменений в выборке не означает ноль изменений в листе
+    assert q.changed.count_high >= 5
+
+
+def test_ratio_interval_floor_for_equal_block_rates():
+    rate, low, high = compare_engine._ratio_interval([5, 5, 5], [100, 100, 100], blocks_total=50)
+    assert rate == 0.05
+    assert 0 < low < rate < high < 1
+    assert compare_engine._ratio_interval([5, 5, 5], [100, 100, 100], blocks_total=3) == (0.05, 0.05, 0.05)
@@ -0,0 +1,218 @@
+import gc
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sheet_cache
+from sheet_cache import MB, SheetCache, object_bytes
+
+
+def make_frame(rows=10_000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'id': np.arange(rows),
+        'amount': rng.random(rows),
+        'name': [f'name {i}' for i in range(rows)],
+    })
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SheetCache(memory_limit=100 * MB, disk_limit=100 * MB, spill_root=str(tmp_path))
+
+
+def test_loader_called_once(cache):
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return make_frame(100)
+
+    first = cache.get(('d1', 'Лист1'), loader, session_id='s1')
+    second = cache.get(('d1', 'Лист1'), loader, session_id='s2')
+
+    assert second is first
+    assert len(calls) == 1
+    metrics = cache.metrics()
+    assert (metrics['hits'], metrics['misses']) == (1, 1)
+    assert metrics['entries_referenced'] == 1
+
+
+def test_parallel_requests_load_once(cache):
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return make_frame(100)
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get(('d1', 'Лист1'), loader)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_spill_round_trip(cache):
+    frame = make_frame()
+    expected = frame.copy()
+    cache.memory_limit = object_bytes(frame) // 2
+    cache.get(('d1', 'Лист1'), lambda: frame)
+    del frame
+    gc.collect()
+
+    metrics = cache.metrics()
+    assert metrics['spills'] == 1
+    assert metrics['memory_mb'] == 0
+    assert metrics['disk_mb'] > 0
+
+    loaded = cache.get(('d1', 'Лист1'), lambda: pytest.fail("лист должен читаться с диска"))
+    assert loaded.equals(expected)
+    assert list(loaded.dtypes) == list(expected.dtypes)
+    assert cache.metrics()['disk_loads'] == 1
+
+
+def test_memory_mapped_columns_not_counted(cache):
+    frame = make_frame()
+    cache.memory_limit = 1
+    cache.get(('d1', 'Лист1'), lambda: frame)
+    del frame
+    gc.collect()
+
+    loaded = cache.get(('d1', 'Лист1'), lambda: None)
+    # Числовые колонки открыты через memory-map и в памяти процесса не считаются
+    assert object_bytes(loaded) == object_bytes(loaded[['name']])
+
+
+def test_held_frame_still_counted_and_reused(cache):
+    frame = make_frame()
+    nbytes = object_bytes(frame)
+    cache.memory_limit = nbytes // 2
+    held = cache.get(('d1', 'Лист1'), lambda: frame)
+    del frame
+
+    # Кэш выгрузил лист, но вызывающий код его держит - память не освободилась
+    metrics = cache.metrics()
+    assert metrics['spills'] == 1
+    assert metrics['entries_held'] == 1
+    assert metrics['memory_mb'] == round(nbytes / MB, 1)
+
+    # Повторный запрос возвращает тот же объект, а не вторую копию с диска
+    again = cache.get(('d1', 'Лист1'), lambda: pytest.fail("лист должен быть в кэше"))
+    assert again is held
+    assert cache.metrics()['disk_loads'] == 0
+
+
+def test_unreferenced_entries_spill_first(cache):
+    nbytes = object_bytes(make_frame())
+    cache.memory_limit = nbytes * 5 // 2
+    cache.get(('d2', 'Лист1'), lambda: make_frame(seed=2), session_id='s1')
+    # Лист d1 использован позже, но на него больше никто не ссылается
+    cache.get(('d1', 'Лист1'), lambda: make_frame(seed=1), session_id='s2')
+    cache.retain('s2', set())
+    gc.collect()
+    cache.get(('d3', 'Лист1'), lambda: make_frame(seed=3), session_id='s1')
+
+    metrics = cache.metrics()
+    assert metrics['spills'] == 1
+    assert metrics['entries_referenced'] == 2
+    assert cache._entries[('d1', 'Лист1')].frame is None
+    assert cache._entries[('d2', 'Лист1')].frame is not None
+
+
+def test_disk_limit_evicts_unreferenced(cache):
+    cache.memory_limit = 1
+    cache.get(('d1', 'Лист1'), lambda: make_frame(seed=1), session_id='s1')
+    cache.get(('d2', 'Лист1'), lambda: make_frame(seed=2), session_id='s1')
+    gc.collect()
+    cache.disk_limit = cache.metrics()['disk_mb'] * MB * 0.75
+
+    # Пока на листы ссылается сессия, они остаются на диске
+    cache.retain('s1', {'d1', 'd2'})
+    assert cache.metrics()['entries'] == 2
+
+    cache.retain('s1', {'d2'})
+    metrics = cache.metrics()
+    assert metrics['evictions'] == 1
+    assert metrics['entries'] == 1
+    assert ('d2', 'Лист1') in cache._entries
+
+
+@dataclass
+class Result:
+    copy: pd.DataFrame
+    source: pd.DataFrame
+    bitmap: np.ndarray
+
+
+def test_results_counted_without_cached_frames(cache):
+    frame = cache.get(('d1', 'Лист1'), lambda: make_frame())
+    bitmap = np.ones((len(frame), 3), dtype=bool)
+    result = cache.get(
+        (('d1', 'd2'), 'compare', 'Лист1'),
+        lambda: Result(copy=frame.fillna(''), source=frame, bitmap=bitmap),
+    )
+
+    # Лист, на который ссылается результат, уже учтен в своей записи
+    entry = cache._entries[(('d1', 'd2'), 'compare', 'Лист1')]
+    assert entry.nbytes == object_bytes(result.copy) + bitmap.nbytes
+    assert cache.metrics()['memory_mb'] == round((object_bytes(frame) + entry.nbytes) / MB, 1)
+
+
+def test_results_spill_and_reload(cache):
+    expected = make_frame()
+    cache.get(
+        (('d1', 'd2'), 'compare', 'Лист1'),
+        lambda: Result(copy=expected.copy(), source=expected.copy(), bitmap=np.zeros((3, 3), dtype=bool)),
+    )
+    cache.memory_limit = 1
+    cache.retain('s1', set())
+    gc.collect()
+    assert cache.metrics()['memory_mb'] == 0
+
+    result = cache.get((('d1', 'd2'), 'compare', 'Лист1'), lambda: pytest.fail("результат должен читаться с диска"))
+    assert isinstance(result, Result)
+    pd.testing.assert_frame_equal(result.copy, expected)
+
+
+def test_retain_releases_results_of_removed_files(cache):
+    cache.get((('d1', 'd2'), 'compare', 'Лист1'), lambda: Result(make_frame(10), make_frame(10), np.zeros(1)),
+              session_id='s1')
+    cache.retain('s1', {'d1', 'd2'})
+    assert cache.metrics()['entries_referenced'] == 1
+    cache.retain('s1', {'d1', 'd3'})
+    assert cache.metrics()['entries_referenced'] == 0
+
+
+def test_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv('EXCEL_APP_CACHE_MB', '16')
+    monkeypatch.setenv('EXCEL_APP_DISK_CACHE_MB', '32')
+    monkeypatch.setenv('EXCEL_APP_CACHE_DIR', str(tmp_path))
+    cache = sheet_cache.from_environment()
+    assert cache.memory_limit == 16 * MB
+    assert cache.disk_limit == 32 * MB
+    assert cache.spill_dir.startswith(str(tmp_path))
+
+
+def test_spill_dir_removed_with_cache(tmp_path):
+    cache = SheetCache(memory_limit=1, disk_limit=100 * MB, spill_root=str(tmp_path))
+    cache.get(('d1', 'Лист1'), lambda: make_frame())
+    gc.collect()
+    assert cache.metrics()['disk_mb'] > 0
+    spill_dir = cache.spill_dir
+
+    del cache
+    gc.collect()
+    assert not os.path.exists(spill_dir)